@@ -11,6 +11,7 @@ import electrum
 from electrum.bitcoin import TYPE_ADDRESS
 from electrum import WalletStorage, Wallet
 from electrum_gui.kivy.i18n import _
+from electrum.storage import delete_wallet
 from electrum.paymentrequest import InvoiceStore
 from electrum.util import profiler, InvalidPassword
 from electrum.plugins import run_hook
@@ -859,7 +860,7 @@ class ElectrumWindow(App):
                 self.show_error("Invalid PIN")
                 return
         self.stop_wallet()
-        os.unlink(wallet_path)
+        delete_wallet(wallet_path)
         self.show_error("Wallet removed:" + basename)
         d = os.listdir(dirname)
         name = 'default_wallet'
@@ -9,6 +9,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
 from electrum import Wallet, WalletStorage
+from electrum.storage import delete_wallet
 from electrum.util import UserCancelled, InvalidPassword
 from electrum.base_wizard import BaseWizard
 from electrum.i18n import _
@@ -249,7 +250,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             file_list = '\n'.join(self.storage.split_accounts())
             msg = _('Your accounts have been moved to') + ':\n' + file_list + '\n\n'+ _('Do you want to delete the old file') + ':\n' + path
             if self.question(msg):
-                os.remove(path)
+                delete_wallet(path)
                 self.show_warning(_('The file was removed'))
             return
 
@@ -265,7 +266,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     "Do you want to complete its creation now?") % path
             if not self.question(msg):
                 if self.question(_("Do you want to delete '%s'?") % path):
-                    os.remove(path)
+                    delete_wallet(path)
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
@@ -49,6 +49,7 @@ from electrum import Transaction
 from electrum import util, bitcoin, commands, coinchooser
 from electrum import paymentrequest
 from electrum.wallet import Multisig_Wallet
+from electrum.storage import delete_wallet
 try:
     from electrum.plot import plot_history
 except:
@@ -404,6 +405,8 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
+                # changes in the journal are not in the wallet file yet
+                self.wallet.storage.compact()
                 shutil.copy2(path, new_path)
                 self.show_message(_("A copy of your wallet file was created in")+" '%s'" % str(new_path), title=_("Wallet backup created"))
             except (IOError, os.error) as reason:
@@ -1961,7 +1964,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         basename = os.path.basename(wallet_path)
         self.gui_object.daemon.stop_wallet(wallet_path)
         self.close()
-        os.unlink(wallet_path)
+        delete_wallet(wallet_path)
         self.show_error("Wallet removed:" + basename)
 
     @protected
@@ -406,7 +406,6 @@ class NetworkChoiceLayout(object):
         self.update()
 
     def follow_server(self, server):
-        self.network.switch_to_interface(server)
         host, port, protocol, proxy, auto_connect = self.network.get_parameters()
         host, port, protocol = server.split(':')
         self.network.set_parameters(host, port, protocol, proxy, auto_connect)
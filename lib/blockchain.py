@@ -21,8 +21,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
+import mmap
+import random
 import threading
+import time
 import struct
+import math
+from collections.abc import Mapping
 from io import BytesIO
 
 from . import util
@@ -30,14 +36,18 @@ from . import bitcoin
 from .bitcoin import *
 import base64
 
-from .equihash import is_gbp_valid
+from .equihash import is_gbp_valid, are_gbp_valid
 import logging
 logging.basicConfig(level=logging.INFO)
 
 # https://en.bitcoin.it/wiki/Target
 MAX_TARGET = 0x0007FFFFFFFF0000000000000000000000000000000000000000000000000000
 
+HASH_SIZE = 32
+
 def serialize_header(res):
+    if isinstance(res, Header):
+        return res.raw
     r = b''
     r += struct.pack("<i", res.get('version'))
     r += str_to_hash(res.get('prev_block_hash'))
@@ -50,18 +60,63 @@ def serialize_header(res):
     return r
 
 def deserialize_header(f, height):
-    f = BytesIO(f)
-    h = {}
-    h['version'] = struct.unpack("<I", f.read(4))[0]
-    h['prev_block_hash'] = hash_to_str(f.read(32))
-    h['merkle_root'] = hash_to_str(f.read(32))
-    h['hash_reserved'] = hash_to_str(f.read(32))
-    h['timestamp'] = struct.unpack("<I", f.read(4))[0]
-    h['bits'] = struct.unpack("<I", f.read(4))[0]
-    h['nonce'] = hash_to_str(f.read(32))
-    h['n_solution'] = base64.b64encode(bytes(deser_char_vector(f))).decode('utf8')
-    h['block_height'] = height
-    return h
+    return Header(bytes(f), height)
+
+
+class Header(Mapping):
+    """A serialized header that reads like the dict deserialize_header
+    used to build.  Fields are decoded from the raw bytes on first
+    access, so the Equihash solution is only base64 encoded when
+    'n_solution' is asked for."""
+
+    __slots__ = ('raw', 'height', '_fields')
+
+    hashes = {'prev_block_hash': 4, 'merkle_root': 36, 'hash_reserved': 68, 'nonce': 108}
+    ints = {'version': 0, 'timestamp': 100, 'bits': 104}
+    keys_order = ('version', 'prev_block_hash', 'merkle_root', 'hash_reserved',
+                  'timestamp', 'bits', 'nonce', 'n_solution', 'block_height')
+
+    def __init__(self, raw, height):
+        self.raw = raw
+        self.height = height
+        self._fields = {}
+
+    def __reduce__(self):
+        return Header, (self.raw, self.height)
+
+    def __getitem__(self, key):
+        try:
+            return self._fields[key]
+        except KeyError:
+            pass
+        if key in self.hashes:
+            i = self.hashes[key]
+            value = hash_to_str(self.raw[i:i+32])
+        elif key in self.ints:
+            value = struct.unpack_from("<I", self.raw, self.ints[key])[0]
+        elif key == 'n_solution':
+            value = base64.b64encode(self.get_solution()).decode('utf8')
+        elif key == 'block_height':
+            value = self.height
+        else:
+            raise KeyError(key)
+        self._fields[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.keys_order)
+
+    def __len__(self):
+        return len(self.keys_order)
+
+    def __repr__(self):
+        return 'Header(%d, %s)' % (self.height, self['prev_block_hash'])
+
+    def get_solution(self):
+        f = BytesIO(self.raw[140:])
+        n = read_vector_size(f)
+        i = 140 + f.tell()
+        return self.raw[i:i+n]
 
 # def deserialize_header(f, height):
 #     h = {}
@@ -82,29 +137,314 @@ def sha256_header(header):
 def hash_header(header):
     if header is None:
         return '0' * 64
+    if isinstance(header, Header):
+        return hash_to_str(Hash(header.raw))
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*64
     return hash_to_str(Hash(serialize_header(header)))
 
+def bits_to_target(bits):
+    bitsN = (bits >> 24) & 0xff
+    # if not (bitsN >= 0x03 and bitsN <= 0x1d):
+    #     raise BaseException("First part of bits should be in [0x03, 0x1d]")
+    bitsBase = bits & 0xffffff
+    # if not (bitsBase >= 0x8000 and bitsBase <= 0x7fffff):
+    #     raise BaseException("Second part of bits should be in [0x8000, 0x7fffff]")
+    if bitsN <= 3:
+        return bitsBase >> (8 * (3 - bitsN))
+    else:
+        return bitsBase << (8 * (bitsN - 3))
+
+def verify_header_target(header, prev_header):
+    """Checks everything but the Equihash solution"""
+    if prev_header:
+        prev_hash = hash_header(prev_header)
+        if prev_hash != header.get('prev_block_hash'):
+            raise BaseException("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
+    _powhash = sha256_header(header)
+    target = bits_to_target(header['bits'])
+    if _powhash > target:
+        raise BaseException("insufficient proof of work: %s vs target %s" % (_powhash, target))
+
+def get_equihash_input(header):
+    if isinstance(header, Header):
+        return header.raw, uint256_from_bytes(header.raw[108:140]), header.get_solution()
+    nonce = uint256_from_bytes(str_to_hash(header.get('nonce')))
+    n_solution = vector_from_bytes(base64.b64decode(header.get('n_solution').encode('utf8')))
+    return serialize_header(header), nonce, n_solution
+
+def chunk_hash_root(hashes):
+    """Commits to the binary hashes of the headers of a chunk"""
+    return hash_to_str(Hash(b''.join(hashes)))
+
+def verify_checkpointed_chunk(index, headers, prev_header, chunk_size, checkpoint):
+    """Checks that headers are the chunk pinned by checkpoint, a
+    (hash, root) pair: the hash of the last header of the chunk, and
+    the chunk_hash_root of all of them, or None."""
+    if len(headers) != chunk_size:
+        raise BaseException("incomplete chunk %d below checkpoint" % index)
+    cp_hash, cp_root = checkpoint
+    hashes = [Hash(header.raw) for header in headers]
+    if cp_root is not None:
+        if chunk_hash_root(hashes) != cp_root:
+            raise BaseException("chunk %d does not match checkpoint root" % index)
+        return
+    prev_hash = hash_header(prev_header) if prev_header else None
+    for header, h in zip(headers, hashes):
+        if prev_hash is not None and prev_hash != header.get('prev_block_hash'):
+            raise BaseException("prev hash mismatch at height %d" % header.get('block_height'))
+        prev_hash = hash_to_str(h)
+    if prev_hash != cp_hash:
+        raise BaseException("chunk %d does not match checkpoint" % index)
+
+def verify_chunk(index, data, prev_header, chunk_size, n, k, checkpoint=None, spot_check=0):
+    """Verifies a chunk of raw headers against the last header of the
+    previous chunk.  Raises on failure.  This does not touch any
+    Blockchain, so it can run in a verification process; network
+    parameters are passed explicitly for the same reason.
+
+    If checkpoint is given, the chunk is accepted on hash linkage to
+    it and only a random spot_check fraction of its headers get their
+    proof of work verified."""
+    num = len(data) // bitcoin.HEADER_SIZE
+    headers = []
+    for i in range(num):
+        raw_header = data[i*bitcoin.HEADER_SIZE:(i+1) * bitcoin.HEADER_SIZE]
+        headers.append(deserialize_header(raw_header, index*chunk_size + i))
+
+    if checkpoint is not None:
+        verify_checkpointed_chunk(index, headers, prev_header, chunk_size, checkpoint)
+        count = int(math.ceil(num * spot_check))
+        headers = sorted(random.sample(headers, min(count, num)), key=lambda h: h.height)
+        for header in headers:
+            verify_header_target(header, None)
+    else:
+        for header in headers:
+            verify_header_target(header, prev_header)
+            prev_header = header
+
+    # solutions of the whole chunk are checked in one batch
+    inputs = [get_equihash_input(header) for header in headers]
+    results = are_gbp_valid(*zip(*inputs), n=n, k=k) if inputs else []
+    for header, valid in zip(headers, results):
+        if not valid:
+            raise BaseException("Equihash invalid at height %d" % header.get('block_height'))
+
+
+def hashes_name(name):
+    '''Name of the hash index of the headers file name'''
+    head, tail = os.path.split(name)
+    if tail == 'blockchain_headers':
+        tail = 'blockchain_hashes'
+    elif tail.startswith('fork_'):
+        tail = 'hashes_' + tail[len('fork_'):]
+    else:
+        tail += '_hashes'
+    return os.path.join(head, tail)
+
+
+class Segment(util.PrintError):
+    """A file of consecutive headers from height start on, and its hash
+    index.  A blockchain is a list of segments, so that a reorg moves
+    segments between blockchains instead of copying headers.  Segments
+    are only used under the lock of the blockchain they belong to."""
+
+    def __init__(self, config, name, start):
+        self.config = config
+        self.name = name
+        self.start = start
+        self._mmap = None
+        self._hashes_mmap = None
+        self.recover()
+        self.update_size()
+
+    def diagnostic_name(self):
+        return self.name
+
+    def recover(self):
+        '''Truncates what an interrupted write may have left at the end
+        of the file: a partly written header, or recent headers that do
+        not link to the ones before them.  Only the last headers are
+        checked, as many as may have been waiting for a flush.'''
+        p = self.path()
+        if not os.path.exists(p):
+            return
+        size = os.path.getsize(p)
+        n = size // bitcoin.HEADER_SIZE
+        window = max(self.config.get('header_write_buffer', 100), NetworkConstants.CHUNK_SIZE)
+        first = max(n - window, 0)
+        with open(p, 'rb') as f:
+            f.seek(first * bitcoin.HEADER_SIZE)
+            data = f.read()
+        prev_hash = None
+        for i in range(n - first):
+            raw = data[i*bitcoin.HEADER_SIZE:(i+1)*bitcoin.HEADER_SIZE]
+            if prev_hash is not None and raw[4:36] != prev_hash:
+                n = first + i
+                break
+            prev_hash = Hash(raw)
+        if n * bitcoin.HEADER_SIZE != size:
+            self.print_error("truncating to %d headers after an interrupted write" % n)
+            with open(p, 'rb+') as f:
+                f.truncate(n * bitcoin.HEADER_SIZE)
+
+    def path(self):
+        return os.path.join(util.get_headers_dir(self.config), self.name)
+
+    def hashes_path(self):
+        '''Index of header hashes, HASH_SIZE bytes per header of path()'''
+        return os.path.join(util.get_headers_dir(self.config), hashes_name(self.name))
+
+    def end(self):
+        '''Height following the last header of the segment'''
+        return self.start + self._size
+
+    def update_size(self):
+        p = self.path()
+        self._size = os.path.getsize(p)//bitcoin.HEADER_SIZE if os.path.exists(p) else 0
+        self._mmap = None
+        self.sync_hashes()
+
+    def get_mmap(self):
+        if self._mmap is None and self._size:
+            with open(self.path(), 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def get_hashes_mmap(self):
+        if self._hashes_mmap is None and self._size:
+            with open(self.hashes_path(), 'rb') as f:
+                self._hashes_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._hashes_mmap
+
+    def truncate_hashes(self, size):
+        p = self.hashes_path()
+        if os.path.exists(p) and os.path.getsize(p) > size * HASH_SIZE:
+            self._hashes_mmap = None
+            with open(p, 'rb+') as f:
+                f.truncate(size * HASH_SIZE)
+
+    def sync_hashes(self):
+        '''Brings the hash index in line with the headers file.  Hashes
+        missing from the index, because headers were just written, or
+        the index was lost or left behind by a crash, are computed from
+        the headers file.'''
+        p = self.hashes_path()
+        if not os.path.exists(p):
+            if not self._size:
+                return
+            open(p, 'wb').close()
+        self._hashes_mmap = None
+        self.truncate_hashes(self._size)
+        if not self._size:
+            return
+        count = os.path.getsize(p) // HASH_SIZE
+        with open(self.path(), 'rb') as f, open(p, 'rb+') as g:
+            if count:
+                # the last entry must match its header, or the index is stale
+                f.seek((count - 1) * bitcoin.HEADER_SIZE)
+                g.seek((count - 1) * HASH_SIZE)
+                if Hash(f.read(bitcoin.HEADER_SIZE)) != g.read(HASH_SIZE):
+                    self.print_error("rebuilding hash index")
+                    count = 0
+            if count == self._size:
+                return
+            f.seek(count * bitcoin.HEADER_SIZE)
+            g.seek(count * HASH_SIZE)
+            g.truncate()
+            while count < self._size:
+                n = min(NetworkConstants.CHUNK_SIZE, self._size - count)
+                data = memoryview(f.read(n * bitcoin.HEADER_SIZE))
+                g.write(b''.join(Hash(data[i*bitcoin.HEADER_SIZE:(i+1)*bitcoin.HEADER_SIZE])
+                                 for i in range(n)))
+                count += n
+            g.flush()
+            os.fsync(g.fileno())
+
+    def write(self, data, offset):
+        self._mmap = None
+        # drop stale hashes first, so that a crash cannot leave
+        # the index ahead of the headers file
+        self.truncate_hashes(offset // bitcoin.HEADER_SIZE)
+        with open(self.path(), 'rb+') as f:
+            if offset != self._size*bitcoin.HEADER_SIZE:
+                f.seek(offset)
+                f.truncate()
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            if self.config.get('header_fsync', True):
+                os.fsync(f.fileno())
+        self.update_size()
+
+    def read(self, height):
+        '''The headers from height on'''
+        m = self.get_mmap()
+        return m[(height - self.start) * bitcoin.HEADER_SIZE:] if m is not None else b''
+
+    def get_raw_header(self, height):
+        offset = (height - self.start) * bitcoin.HEADER_SIZE
+        m = self.get_mmap()
+        if height < self.start or m is None or len(m) < offset + bitcoin.HEADER_SIZE:
+            return
+        return memoryview(m)[offset:offset + bitcoin.HEADER_SIZE]
+
+    def get_hash(self, height):
+        offset = (height - self.start) * HASH_SIZE
+        m = self.get_hashes_mmap()
+        if height < self.start or m is None or len(m) < offset + HASH_SIZE:
+            return
+        return hash_to_str(m[offset:offset + HASH_SIZE])
+
+    def remove(self):
+        self._mmap = self._hashes_mmap = None
+        for p in [self.path(), self.hashes_path()]:
+            if os.path.exists(p):
+                os.remove(p)
+
 
 blockchains = {}
 
+def segments_path(config):
+    return os.path.join(util.get_headers_dir(config), 'blockchain_segments')
+
+def save_segments(config):
+    '''Stores which segments each blockchain is made of'''
+    table = sorted([b.checkpoint, b.parent_id, [[x.name, x.start] for x in b.segments]]
+                   for b in blockchains.values())
+    path = segments_path(config)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(table))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
 def read_blockchains(config):
-    blockchains[0] = Blockchain(config, 0, None)
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     if not os.path.exists(fdir):
         os.mkdir(fdir)
-    l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
-    l = sorted(l, key = lambda x: int(x.split('_')[1]))
-    for filename in l:
-        checkpoint = int(filename.split('_')[2])
-        parent_id = int(filename.split('_')[1])
-        b = Blockchain(config, checkpoint, parent_id)
-        h = b.read_header(b.checkpoint)
-        if b.parent().can_connect(h, check_height=False):
-            blockchains[b.checkpoint] = b
-        else:
-            util.print_error("cannot connect", filename)
+    path = segments_path(config)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            table = json.loads(f.read())
+    else:
+        # one file per blockchain, named after it
+        table = [[0, None, None]]
+        l = filter(lambda x: x.startswith('fork_'), os.listdir(fdir))
+        l = sorted(l, key = lambda x: int(x.split('_')[1]))
+        for filename in l:
+            checkpoint = int(filename.split('_')[2])
+            parent_id = int(filename.split('_')[1])
+            table.append([checkpoint, parent_id, None])
+    for checkpoint, parent_id, segments in table:
+        b = Blockchain(config, checkpoint, parent_id, segments)
+        if parent_id is not None:
+            h = b.read_header(b.checkpoint)
+            if not b.parent().can_connect(h, check_height=False):
+                util.print_error("cannot connect", b.path())
+                continue
+        blockchains[b.checkpoint] = b
+    save_segments(config)
     return blockchains
 
 def check_header(header):
@@ -121,18 +461,41 @@ def can_connect(header):
             return b
     return False
 
+def new_segment(config, start):
+    '''Creates an empty segment for headers from height start on'''
+    n = 0
+    while True:
+        name = os.path.join('forks', 'segment_%d_%d' % (start, n))
+        path = os.path.join(util.get_headers_dir(config), name)
+        if not os.path.exists(path):
+            break
+        n += 1
+    open(path, 'wb').close()
+    return Segment(config, name, start)
+
 
 class Blockchain(util.PrintError):
     """
     Manages blockchain headers and their verification
     """
 
-    def __init__(self, config, checkpoint, parent_id):
+    def __init__(self, config, checkpoint, parent_id, segments=None):
         self.config = config
         self.catch_up = None # interface catching up
         self.checkpoint = checkpoint
         self.checkpoints = NetworkConstants.CHECKPOINTS
         self.parent_id = parent_id
+        if segments is None:
+            filename = 'blockchain_headers' if parent_id is None else os.path.join('forks', 'fork_%d_%d'%(parent_id, checkpoint))
+            segments = [(filename, checkpoint)]
+        self.segments = [Segment(config, name, start) for name, start in segments]
+        # serialized headers following the last segment, not written yet
+        self.pending = []
+        self.pending_time = None
+        # recently used headers and hashes, keyed by height
+        cache_size = config.get('header_cache_size', 1000)
+        self.headers_cache = util.LRUCache(cache_size)
+        self.hashes_cache = util.LRUCache(cache_size)
         self.lock = threading.Lock()
         with self.lock:
             self.update_size()
@@ -161,8 +524,13 @@ class Blockchain(util.PrintError):
 
     def fork(parent, header):
         checkpoint = header.get('block_height')
-        self = Blockchain(parent.config, checkpoint, parent.checkpoint)
-        open(self.path(), 'w+').close()
+        parent.flush()
+        with parent.lock:
+            parent.split(checkpoint)
+        segment = new_segment(parent.config, checkpoint)
+        self = Blockchain(parent.config, checkpoint, parent.checkpoint, [(segment.name, checkpoint)])
+        blockchains[checkpoint] = self
+        save_segments(self.config)
         self.save_header(header)
         return self
 
@@ -174,40 +542,102 @@ class Blockchain(util.PrintError):
             return self._size
 
     def update_size(self):
-        p = self.path()
-        self._size = os.path.getsize(p)//bitcoin.HEADER_SIZE if os.path.exists(p) else 0
+        for segment in self.segments:
+            segment.update_size()
+        self.set_size()
+
+    def set_size(self):
+        self._size = self.segments[-1].end() - self.checkpoint + len(self.pending)
+
+    def flush(self, force=True):
+        '''Writes the buffered headers, unless force is False and there
+        are fewer than 'header_write_buffer' of them, buffered for less
+        than 'header_write_delay' seconds.'''
+        with self.lock:
+            if not self.pending:
+                return
+            if not force \
+               and len(self.pending) < self.config.get('header_write_buffer', 100) \
+               and time.time() - self.pending_time < self.config.get('header_write_delay', 10):
+                return
+            segment = self.segments[-1]
+            segment.write(b''.join(self.pending), segment._size * bitcoin.HEADER_SIZE)
+            self.pending = []
+            self.pending_time = None
+            self.set_size()
+
+    def get_segment(self, height):
+        # call with self.lock held
+        for segment in reversed(self.segments):
+            if segment.start <= height:
+                return segment
+
+    def split(self, height):
+        '''Makes a segment start at height, moving the headers from height
+        on out of the segment holding them.  Call with self.lock held.'''
+        segment = self.get_segment(height)
+        if segment is None or segment.start == height or height > segment.end():
+            return
+        new = new_segment(self.config, height)
+        new.write(segment.read(height), 0)
+        self.segments.insert(self.segments.index(segment) + 1, new)
+        save_segments(self.config)
+        segment.write(b'', (height - segment.start) * bitcoin.HEADER_SIZE)
 
     def verify_header(self, header, prev_header):
-        if prev_header:
-            prev_hash = hash_header(prev_header)
-            if prev_hash != header.get('prev_block_hash'):
-                raise BaseException("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
-        _powhash = sha256_header(header)
-        target = self.bits_to_target(header['bits'])
-        if _powhash > target:
-            raise BaseException("insufficient proof of work: %s vs target %s" % (int('0x' + _powhash, 16), target))
-        nonce = uint256_from_bytes(str_to_hash(header.get('nonce')))
-        n_solution = vector_from_bytes(base64.b64decode(header.get('n_solution').encode('utf8')))
-        if not is_gbp_valid(serialize_header(header), nonce, n_solution,
-            NetworkConstants.EQUIHASH_N, NetworkConstants.EQUIHASH_K):
+        verify_header_target(header, prev_header)
+        if not is_gbp_valid(*get_equihash_input(header),
+            n=NetworkConstants.EQUIHASH_N, k=NetworkConstants.EQUIHASH_K):
             raise BaseException("Equihash invalid")
 
+    def checkpoint_at(self, index):
+        """The (hash, root) pair pinning chunk index, or None above the
+        newest checkpoint.  root is None for checkpoints without a chunk
+        hash root."""
+        if index >= len(self.checkpoints):
+            return
+        cp = self.checkpoints[index]
+        return cp[0], cp[2] if len(cp) > 2 else None
+
+    def get_chunk_checkpoint(self, index):
+        """checkpoint_at(index), if headers below the newest checkpoint
+        are trusted"""
+        if not self.config.get('checkpoint_trust', False):
+            return
+        return self.checkpoint_at(index)
+
+    def get_spot_check(self):
+        """Fraction of checkpointed headers whose proof of work is checked"""
+        return self.config.get('checkpoint_spot_check', 0.05)
+
+    def get_checkpoints(self):
+        """Checkpoints for the complete chunks of this blockchain, in the
+        format of checkpoints.json: the hash of the last header of each
+        chunk, its target and the hash root of the chunk."""
+        cp = []
+        n = self.height() // NetworkConstants.CHUNK_SIZE
+        for index in range(n):
+            end = (index + 1) * NetworkConstants.CHUNK_SIZE
+            hashes = [bytes.fromhex(self.get_hash(h))[::-1]
+                      for h in range(end - NetworkConstants.CHUNK_SIZE, end)]
+            header = self.read_header(end - 1)
+            cp.append([self.get_hash(end - 1), self.bits_to_target(header['bits']),
+                       chunk_hash_root(hashes)])
+        return cp
+
     def verify_chunk(self, index, data):
-        num = len(data) // bitcoin.HEADER_SIZE
         prev_header = None
         if index != 0:
             prev_header = self.read_header(index * NetworkConstants.CHUNK_SIZE - 1)
-
-        for i in range(num):
-            raw_header = data[i*bitcoin.HEADER_SIZE:(i+1) * bitcoin.HEADER_SIZE]
-            header = deserialize_header(raw_header, index*NetworkConstants.CHUNK_SIZE + i)
-            self.verify_header(header, prev_header)
-            prev_header = header
+        verify_chunk(index, data, prev_header, NetworkConstants.CHUNK_SIZE,
+                     NetworkConstants.EQUIHASH_N, NetworkConstants.EQUIHASH_K,
+                     self.get_chunk_checkpoint(index), self.get_spot_check())
 
     def path(self):
-        d = util.get_headers_dir(self.config)
-        filename = 'blockchain_headers' if self.parent_id is None else os.path.join('forks', 'fork_%d_%d'%(self.parent_id, self.checkpoint))
-        return os.path.join(d, filename)
+        return self.segments[0].path()
+
+    def hashes_path(self):
+        return self.segments[0].hashes_path()
 
     def save_chunk(self, index, chunk):
         filename = self.path()
@@ -228,86 +658,149 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
-        with open(self.path(), 'rb') as f:
-            my_data = f.read()
-        with open(parent.path(), 'rb') as f:
-            f.seek((checkpoint - parent.checkpoint)*bitcoin.HEADER_SIZE)
-            parent_data = f.read(parent_branch_size*bitcoin.HEADER_SIZE)
-
-        self.write(parent_data, 0)
-        parent.write(my_data, (checkpoint - parent.checkpoint)*bitcoin.HEADER_SIZE)
-        # store file path
-        for b in blockchains.values():
-            b.old_path = b.path()
-        # swap parameters
-        self.parent_id = parent.parent_id; parent.parent_id = parent_id
-        self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
-        self._size = parent._size; parent._size = parent_branch_size
-        # move files
-        for b in blockchains.values():
-            if b in [self, parent]: continue
-            if b.old_path != b.path():
-                self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
+        self.flush()
+        parent.flush()
+        with parent.lock, self.lock:
+            # exchange the segments above the checkpoint
+            parent.split(checkpoint)
+            below = [x for x in parent.segments if x.start < checkpoint]
+            above = [x for x in parent.segments if x.start >= checkpoint]
+            self.segments, parent.segments = below + self.segments, above
+            # swap parameters
+            self.parent_id = parent.parent_id; parent.parent_id = parent_id
+            self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
+            for b in [self, parent]:
+                b.set_size()
+                b.clear_cache()
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
+        save_segments(self.config)
 
     def write(self, data, offset):
-        filename = self.path()
+        '''Writes data at offset, dropping what follows.  Segment
+        boundaries are kept, so that forks can still be swapped without
+        copying.'''
+        height = self.checkpoint + offset // bitcoin.HEADER_SIZE
+        self.flush()
         with self.lock:
-            with open(filename, 'rb+') as f:
-                if offset != self._size*bitcoin.HEADER_SIZE:
-                    f.seek(offset)
-                    f.truncate()
-                f.seek(offset)
-                f.write(data)
-                f.flush()
-                os.fsync(f.fileno())
-            self.update_size()
+            self.clear_cache(height)
+            segments = self.segments
+            i = segments.index(self.get_segment(height))
+            for j in range(i, len(segments)):
+                segment = segments[j]
+                if j > i and not data:
+                    self.segments = segments[:j]
+                    save_segments(self.config)
+                    for x in segments[j:]:
+                        x.remove()
+                    break
+                n = len(data)
+                if j + 1 < len(segments):
+                    n = min(n, (segments[j + 1].start - height) * bitcoin.HEADER_SIZE)
+                segment.write(data[:n], (height - segment.start) * bitcoin.HEADER_SIZE)
+                data = data[n:]
+                height += n // bitcoin.HEADER_SIZE
+            self.set_size()
 
     def save_header(self, header):
         delta = header.get('block_height') - self.checkpoint
         data = serialize_header(header)
         assert delta == self.size()
         assert len(data) == bitcoin.HEADER_SIZE
-        self.write(data, delta*bitcoin.HEADER_SIZE)
+        with self.lock:
+            self.pending.append(data)
+            if self.pending_time is None:
+                self.pending_time = time.time()
+            self.set_size()
+        self.flush(False)
         self.swap_with_parent()
 
-    def read_header(self, height):
+    def get_branch(self, height):
+        '''The blockchain whose file stores the header at height'''
         assert self.parent_id != self.checkpoint
         if height < 0:
             return
         if height < self.checkpoint:
-            return self.parent().read_header(height)
+            return self.parent().get_branch(height)
         if height > self.height():
             return
+        return self
 
-        delta = height - self.checkpoint
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * bitcoin.HEADER_SIZE)
-                h = f.read(bitcoin.HEADER_SIZE)
-        return deserialize_header(h, height)
+    def clear_cache(self, height=None):
+        """Forgets cached headers and hashes from height on, or all of
+        them.  Call with self.lock held."""
+        for cache in [self.headers_cache, self.hashes_cache]:
+            if height is None:
+                cache.clear()
+                continue
+            for h in cache.keys():
+                if h >= height:
+                    cache.pop(h)
+
+    def get_cache_stats(self):
+        with self.lock:
+            return {'headers': self.headers_cache.stats(),
+                    'hashes': self.hashes_cache.stats()}
+
+    def get_raw_header(self, height):
+        # call with self.lock held, on the branch storing height
+        i = height - self.segments[-1].end()
+        if i >= 0:
+            return memoryview(self.pending[i]) if i < len(self.pending) else None
+        segment = self.get_segment(height)
+        return segment.get_raw_header(height) if segment else None
+
+    def read_raw_header(self, height, func=bytes):
+        """Calls func with a memoryview of the serialized header at height,
+        sliced from the memory-mapped headers file, and returns the result.
+        func runs under the lock and must not keep the view: it is no
+        longer valid once the file is written."""
+        b = self.get_branch(height)
+        if b is None:
+            return
+        with b.lock:
+            raw = b.get_raw_header(height)
+            if raw is None:
+                return
+            return func(raw)
+
+    def read_header(self, height):
+        b = self.get_branch(height)
+        if b is None:
+            return
+        with b.lock:
+            header = b.headers_cache.get(height)
+            if header is None:
+                raw = b.get_raw_header(height)
+                if raw is None:
+                    return
+                header = b.headers_cache[height] = Header(bytes(raw), height)
+            return header
 
     def get_hash(self, height):
-        return self.hash_header(self.read_header(height))
+        b = self.get_branch(height)
+        if b is None:
+            return '0' * 64
+        with b.lock:
+            h = b.hashes_cache.get(height)
+            if h is None:
+                if height >= b.segments[-1].end():
+                    raw = b.get_raw_header(height)
+                    h = hash_to_str(Hash(raw)) if raw is not None else None
+                else:
+                    segment = b.get_segment(height)
+                    h = segment.get_hash(height) if segment else None
+                if h is None:
+                    return '0' * 64
+                b.hashes_cache[height] = h
+            return h
 
     def hash_header(self, header):
         return hash_header(header)
 
     def bits_to_target(self, bits):
-        bitsN = (bits >> 24) & 0xff
-        # if not (bitsN >= 0x03 and bitsN <= 0x1d):
-        #     raise BaseException("First part of bits should be in [0x03, 0x1d]")
-        bitsBase = bits & 0xffffff
-        # if not (bitsBase >= 0x8000 and bitsBase <= 0x7fffff):
-        #     raise BaseException("Second part of bits should be in [0x8000, 0x7fffff]")
-        if bitsN <= 3:
-            return bitsBase >> (8 * (3 - bitsN))
-        else:
-            return bitsBase << (8 * (bitsN - 3))
+        return bits_to_target(bits)
 
     def target_to_bits(self, target):
         c = ("%064x" % target)[2:]
@@ -329,7 +822,7 @@ class Blockchain(util.PrintError):
             return hash_header(header) == NetworkConstants.GENESIS
         try:
             prev_header = self.read_header(height - 1)
-            prev_hash = self.hash_header(prev_header)
+            prev_hash = self.get_hash(height - 1)
         except:
             return False
         if prev_hash != header.get('prev_block_hash'):
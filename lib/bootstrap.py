@@ -0,0 +1,138 @@
+# Electrum - Lightweight Bitcoin Client
+# Copyright (c) 2012 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+
+import requests
+
+from . import bitcoin
+from . import blockchain
+from .bitcoin import NetworkConstants
+from .util import PrintError
+
+
+class HeadersBootstrap(PrintError):
+    """Imports a headers snapshot, a file in the format of
+    blockchain_headers found at a local path or a URL, into a blockchain.
+
+    The snapshot is streamed one chunk at a time, starting with the first
+    chunk missing from the blockchain, so an interrupted import resumes
+    where it stopped.  Nothing is read unless the snapshot has complete
+    chunks past the end of the blockchain; a snapshot of unknown size is
+    only imported into an empty blockchain.  With checkpoint_trust set,
+    chunks below the newest checkpoint are checked against it; other
+    chunks are fully verified.  Only verified chunks are written, and an
+    incomplete last chunk is left to the network."""
+
+    def __init__(self, blockchain, source):
+        self.blockchain = blockchain
+        self.source = source
+
+    def is_url(self):
+        return self.source.startswith(('http://', 'https://'))
+
+    def snapshot_size(self):
+        """Size of the snapshot in bytes, or None if unknown"""
+        if not self.is_url():
+            return os.path.getsize(self.source) if os.path.exists(self.source) else None
+        try:
+            r = requests.head(self.source, headers={'User-Agent': 'Electrum'},
+                              timeout=30, allow_redirects=True)
+            r.raise_for_status()
+            return int(r.headers['Content-Length'])
+        except BaseException as e:
+            self.print_error("cannot get snapshot size:", str(e))
+            return None
+
+    def is_required(self):
+        """Whether the snapshot has chunks the blockchain lacks"""
+        index = self.blockchain.size() // NetworkConstants.CHUNK_SIZE
+        size = self.snapshot_size()
+        if size is None:
+            return index == 0
+        return size // (NetworkConstants.CHUNK_SIZE * bitcoin.HEADER_SIZE) > index
+
+    def read_chunks(self, offset):
+        size = NetworkConstants.CHUNK_SIZE * bitcoin.HEADER_SIZE
+        if not self.is_url():
+            with open(self.source, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size)
+                while len(data) == size:
+                    yield data
+                    data = f.read(size)
+            return
+        headers = {'User-Agent': 'Electrum', 'Range': 'bytes=%d-' % offset}
+        r = requests.get(self.source, headers=headers, stream=True, timeout=30)
+        try:
+            if r.status_code == 416:
+                # nothing past offset
+                return
+            r.raise_for_status()
+            # servers that ignore the range send the whole file
+            skip = offset if r.status_code != 206 else 0
+            buf = bytearray()
+            for data in r.iter_content(size):
+                if skip:
+                    n = min(skip, len(data))
+                    data = data[n:]
+                    skip -= n
+                buf += data
+                while len(buf) >= size:
+                    yield bytes(buf[:size])
+                    del buf[:size]
+        finally:
+            r.close()
+
+    def verify_chunk(self, index, data):
+        b = self.blockchain
+        if index == 0:
+            prev_header = None
+            genesis = blockchain.deserialize_header(data[:bitcoin.HEADER_SIZE], 0)
+            if blockchain.hash_header(genesis) != NetworkConstants.GENESIS:
+                raise BaseException("genesis mismatch")
+        else:
+            prev_header = b.read_header(index * NetworkConstants.CHUNK_SIZE - 1)
+        blockchain.verify_chunk(index, data, prev_header, NetworkConstants.CHUNK_SIZE,
+                                NetworkConstants.EQUIHASH_N, NetworkConstants.EQUIHASH_K,
+                                b.get_chunk_checkpoint(index), b.get_spot_check())
+
+    def run(self):
+        """Returns the number of chunks imported"""
+        b = self.blockchain
+        if not self.is_required():
+            self.print_error("blockchain is not behind", self.source)
+            return 0
+        index = b.size() // NetworkConstants.CHUNK_SIZE
+        self.print_error("importing headers from", self.source, "at chunk", index)
+        count = 0
+        for data in self.read_chunks(index * NetworkConstants.CHUNK_SIZE * bitcoin.HEADER_SIZE):
+            try:
+                self.verify_chunk(index, data)
+            except BaseException as e:
+                self.print_error("chunk %d rejected:" % index, str(e))
+                break
+            b.save_chunk(index, data)
+            index += 1
+            count += 1
+        self.print_error("imported %d chunks, height %d" % (count, b.height()))
+        return count
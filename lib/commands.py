@@ -448,11 +448,11 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self):
+    def history(self, offset=0, limit=None):
         """Wallet history. Returns the transaction history of your wallet."""
         balance = 0
         out = []
-        for item in self.wallet.get_history():
+        for item in self.wallet.get_history(offset=offset, limit=limit):
             tx_hash, height, conf, timestamp, value, balance = item
             if timestamp:
                 date = datetime.datetime.fromtimestamp(timestamp).isoformat(' ')[:-3]
@@ -727,6 +727,8 @@ command_options = {
     'pending':     (None, "Show only pending requests."),
     'expired':     (None, "Show only expired requests."),
     'paid':        (None, "Show only paid requests."),
+    'offset':      (None, "Skip this many of the most recent transactions"),
+    'limit':       (None, "Show at most this many transactions"),
 }
 
 
@@ -746,6 +748,8 @@ arg_types = {
     'fee': lambda x: str(Decimal(x)) if x is not None else None,
     'amount': lambda x: str(Decimal(x)) if x != '!' else '!',
     'locktime': int,
+    'offset': int,
+    'limit': int,
 }
 
 config_variables = {
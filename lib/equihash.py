@@ -4,6 +4,11 @@ from operator import itemgetter
 import struct
 from functools import reduce
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 DEBUG = False
 VERBOSE = False
 
@@ -291,6 +296,81 @@ def gbp_validate(digest, minimal, n, k):
     return True
 
 
+def gbp_validate_batch(digests, minimals, n, k):
+    '''Validate several solutions at once.  Returns a list of booleans,
+    one per (digest, minimal) pair, with the same outcome as calling
+    gbp_validate on each pair.  Index expansion, the XOR tree and the
+    collision checks run on NumPy arrays; without NumPy this falls back
+    to gbp_validate.'''
+    validate_params(n, k)
+    if np is None:
+        return [gbp_validate(d, m, n, k) for d, m in zip(digests, minimals)]
+    collision_length = n//(k+1)
+    hash_length = (k+1)*((collision_length+7)//8)
+    indices_per_hash_output = 512//n
+    solution_width = (1 << k)*(collision_length+1)//8
+    num_indices = 1 << k
+    hash_bytes = n//8
+
+    result = [len(m) == solution_width for m in minimals]
+    batch = [j for j, ok in enumerate(result) if ok]
+    if not batch:
+        return result
+    size = len(batch)
+
+    # Indices: split each minimal solution into (collision_length+1)-bit
+    # big-endian integers
+    sol = np.frombuffer(b''.join(bytes(minimals[j]) for j in batch), dtype=np.uint8)
+    bits = np.unpackbits(sol.reshape(size, solution_width), axis=1)
+    bits = bits.reshape(size, num_indices, collision_length+1).astype(np.uint32)
+    weights = np.left_shift(1, np.arange(collision_length, -1, -1, dtype=np.uint32))
+    indices = bits.dot(weights)
+
+    # X_i = H(I||V||x_i), hashing each BLAKE2b output once per solution
+    hashes = bytearray()
+    for row, j in zip(indices.tolist(), batch):
+        cache = {}
+        for i in row:
+            g, r = divmod(i, indices_per_hash_output)
+            tmp_hash = cache.get(g)
+            if tmp_hash is None:
+                curr_digest = digests[j].copy()
+                hash_xi(curr_digest, g)
+                tmp_hash = cache[g] = curr_digest.digest()
+            hashes += tmp_hash[r*hash_bytes:(r+1)*hash_bytes]
+    X = np.frombuffer(bytes(hashes), dtype=np.uint8)
+    X = X.reshape(size, num_indices, hash_bytes)
+
+    # Same layout as expand_array: every collision_length-bit chunk is
+    # left-padded with zero bits to a whole number of bytes
+    width = (collision_length+7)//8
+    bits = np.unpackbits(X, axis=2)[:, :, :(k+1)*collision_length]
+    bits = bits.reshape(size, num_indices, k+1, collision_length)
+    pad = np.zeros((size, num_indices, k+1, 8*width - collision_length), dtype=np.uint8)
+    X = np.packbits(np.concatenate((pad, bits), axis=3), axis=3)
+    X = X.reshape(size, num_indices, hash_length)
+
+    # Sibling subtrees must not share indices; over all rounds this is
+    # the same as every index of a solution being distinct
+    s = np.sort(indices, axis=1)
+    valid = (s[:, 1:] != s[:, :-1]).all(axis=1)
+
+    first = indices
+    for r in range(1, k+1):
+        left, right = X[:, 0::2], X[:, 1::2]
+        a, b = (r-1)*collision_length//8, r*collision_length//8
+        valid &= (left[:, :, a:b] == right[:, :, a:b]).all(axis=(1, 2))
+        valid &= (first[:, 0::2] <= first[:, 1::2]).all(axis=1)
+        first = first[:, 0::2]
+        X = left ^ right
+
+    valid &= (X == 0).all(axis=(1, 2))
+
+    for j, ok in zip(batch, valid.tolist()):
+        result[j] = ok
+    return result
+
+
 def zcash_person(n, k):
     return b'ZcashPoW' + struct.pack('<II', n, k)
 
@@ -311,10 +391,22 @@ def validate_params(n, k):
 
 # a bit different from https://github.com/zcash/zcash/blob/master/qa/rpc-tests/test_framework/mininode.py#L747
 # since electrum is a SPV oriented and not a node
-def is_gbp_valid(header, nNonce, nSolution, n=48, k=5):
+def header_digest(header, nNonce, n, k):
     # H(I||...
     digest = blake2b(digest_size=(512//n)*n//8, person=zcash_person(n, k))
     digest.update(header[:108])
     hash_nonce(digest, nNonce)
+    return digest
+
+
+def is_gbp_valid(header, nNonce, nSolution, n=48, k=5):
+    digest = header_digest(header, nNonce, n, k)
     return gbp_validate(digest, nSolution, n, k)
 
+
+def are_gbp_valid(headers, nNonces, nSolutions, n=48, k=5):
+    '''Batched is_gbp_valid, e.g. for all headers of a chunk.'''
+    digests = [header_digest(header, nNonce, n, k)
+               for header, nNonce in zip(headers, nNonces)]
+    return gbp_validate_batch(digests, nSolutions, n, k)
+
@@ -239,10 +239,21 @@ class Interface(util.PrintError):
     electrum server.  It's exposed API is:
 
     - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+      ping_required(), queue_request(), send_requests(), stats()
     - Member variable server.
+
+    The number of requests in flight is limited by an adaptive window:
+    it grows as responses arrive, by one per response up to
+    slow_start_threshold and by about one per round trip after that,
+    and is halved when a response is an error or takes longer than
+    target_latency seconds.
     """
 
+    initial_window = 10
+    min_window = 5
+    max_window = 1000
+    target_latency = 2.0
+
     def __init__(self, server, socket):
         self.server = server
         self.host, _, _ = server.rsplit(':', 2)
@@ -254,6 +265,20 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # wire ID -> time the request was sent
+        self.send_times = {}
+        self.window = self.initial_window
+        self.slow_start_threshold = self.max_window
+        self.last_decrease = 0
+        self.latency = None
+        self.num_responses = 0
+        self.num_errors = 0
+        self.throughput = 0.0
+        self.throughput_time = time.time()
+        self.throughput_count = 0
+        # Send requests as JSON-RPC 2.0 batches of up to batch_size
+        # requests, if the server supports them.  0 disables batches.
+        self.batch_size = 0
         # Set last ping to zero to ensure immediate ping
         self.last_request = time.time()
         self.last_ping = 0
@@ -282,27 +307,87 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the window'''
+        n = int(self.window) - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
+
+    def wants_write(self):
+        '''Whether there are requests, or the rest of requests already
+        sent, to write to the socket.'''
+        return bool(self.pipe.unsent) or self.num_requests() > 0
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
+        if not self.pipe.flush():
+            # the socket did not take the previous ones yet
+            return True
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        messages = [make_dict(*r) for r in wire_requests]
+        if self.batch_size > 1 and n > 1:
+            for m in messages:
+                m['jsonrpc'] = '2.0'
+            size = self.batch_size
+            messages = [messages[i:i + size] for i in range(0, n, size)]
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            self.pipe.send_all(messages)
         except socket.error as e:
             self.print_error("socket error:", e)
             return False
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.send_times[request[2]] = now
         return True
 
+    def on_response(self, send_time, error):
+        '''Adjust the request window for a response to a request sent at
+        send_time.'''
+        now = time.time()
+        latency = now - send_time
+        self.latency = latency if self.latency is None else 0.875 * self.latency + 0.125 * latency
+        self.num_responses += 1
+        self.throughput_count += 1
+        self.update_throughput()
+        if error:
+            self.num_errors += 1
+        if error or latency > self.target_latency:
+            # Only once per round trip: requests sent before the last
+            # decrease were sent with the larger window.
+            if send_time > self.last_decrease:
+                self.window = max(self.min_window, self.window / 2)
+                self.slow_start_threshold = self.window
+                self.last_decrease = now
+        elif self.window < self.slow_start_threshold:
+            self.window = min(self.window + 1, self.max_window)
+        else:
+            self.window = min(self.window + 1 / self.window, self.max_window)
+
+    def update_throughput(self):
+        '''Responses per second, over intervals of at least a second.'''
+        now = time.time()
+        if now - self.throughput_time >= 1:
+            self.throughput = self.throughput_count / (now - self.throughput_time)
+            self.throughput_time = now
+            self.throughput_count = 0
+
+    def stats(self):
+        '''Request window and throughput statistics.'''
+        self.update_throughput()
+        return {
+            'window': int(self.window),
+            'in_flight': len(self.unanswered_requests),
+            'queued': len(self.unsent_requests),
+            'responses': self.num_responses,
+            'errors': self.num_errors,
+            'latency': self.latency,
+            'throughput': self.throughput,
+        }
+
     def ping_required(self):
         '''Maintains time since last ping.  Returns True if a ping should
         be sent.
@@ -328,7 +413,8 @@ class Interface(util.PrintError):
         unsolicited responses presumably as a result of prior
         subscriptions, so request is None and there is no 'id' member.
         Otherwise it is a response, which has an 'id' member and a
-        corresponding request.  If the connection was closed remotely
+        corresponding request.  The responses to a batch of requests
+        are returned one by one.  If the connection was closed remotely
         or the remote server is misbehaving, a (None, None) will appear.
         '''
         responses = []
@@ -337,25 +423,36 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
-            if not type(response) is dict:
-                responses.append((None, None))
-                if response is None:
-                    self.closed_remotely = True
-                    self.print_error("connection closed remotely")
-                break
-            if self.debug:
-                self.print_error("<--", response)
-            wire_id = response.get('id', None)
-            if wire_id is None:  # Notification
-                responses.append((None, response))
-            else:
-                request = self.unanswered_requests.pop(wire_id, None)
-                if request:
-                    responses.append((request, response))
+            batch = response if type(response) is list and response else [response]
+            for response in batch:
+                if not type(response) is dict:
+                    responses.append((None, None))
+                    if response is None:
+                        self.closed_remotely = True
+                        self.print_error("connection closed remotely")
+                    return responses
+                if self.debug:
+                    self.print_error("<--", response)
+                wire_id = response.get('id', None)
+                if wire_id is None:
+                    if response.get('method') is None:
+                        # e.g. the server could not parse a batch
+                        self.print_error("error response", response)
+                        responses.append((None, None))
+                        return responses
+                    # Notification
+                    responses.append((None, response))
                 else:
-                    self.print_error("unknown wire ID", wire_id)
-                    responses.append((None, None)) # Signal
-                    break
+                    request = self.unanswered_requests.pop(wire_id, None)
+                    if request:
+                        send_time = self.send_times.pop(wire_id, None)
+                        if send_time is not None:
+                            self.on_response(send_time, response.get('error') is not None)
+                        responses.append((request, response))
+                    else:
+                        self.print_error("unknown wire ID", wire_id)
+                        responses.append((None, None)) # Signal
+                        return responses
 
         return responses
 
@@ -22,28 +22,54 @@
 # SOFTWARE.
 import time
 import queue
+import hashlib
 import os
 import stat
-import errno
 import random
 import re
-import select
+import sys
+import asyncio
+import multiprocessing
 from collections import defaultdict
 import threading
 import socket
 import json
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 import socks
 from . import util
 from . import bitcoin
 from .bitcoin import *
-from .interface import Connection, Interface
+from .interface import TcpConnection, Interface
 from . import blockchain
+from .bootstrap import HeadersBootstrap
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+MAINTENANCE_INTERVAL = 1
+
+# Read-only requests that any server following our blockchain can
+# answer; they are spread over the connected interfaces.
+FANOUT_METHODS = set([
+    'blockchain.scripthash.get_history',
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+])
+
+
+# Before Python 3.7, process pools cannot choose their start method;
+# forking from the network thread of a GUI process is not safe
+SPAWN_POOLS = sys.version_info >= (3, 7)
+
+
+def new_process_pool(n):
+    '''A pool of n worker processes that are started fresh rather than
+    forked.'''
+    if not SPAWN_POOLS:
+        return ProcessPoolExecutor(max_workers=n)
+    return ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context('spawn'))
 
 
 def parse_servers(result):
@@ -72,6 +98,15 @@ def parse_servers(result):
             servers[host] = out
     return servers
 
+def history_status(history):
+    '''The status hash of an address history, as returned by
+    blockchain.scripthash.get_history'''
+    if not history:
+        return None
+    status = ''.join('%s:%d:' % (item['tx_hash'], item['height']) for item in history)
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 def filter_version(servers):
     def is_recent(version):
         try:
@@ -150,14 +185,27 @@ def serialize_server(host, port, protocol):
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
-    Connections are initiated by a Connection() thread which stops once
-    the connection succeeds or fails.
+    Connections are made by TcpConnection() jobs on a small thread pool,
+    which place the socket on socket_queue once they succeed or fail.
+
+    Subscriptions and other requests go to the main interface.
+    Read-only requests (FANOUT_METHODS) are spread over the interfaces
+    that follow the same blockchain, and go back to the main interface
+    if the answer is an error, or does not match a subscription.
+
+    The network thread runs an asyncio event loop.  Sockets are read
+    when they become readable, and written to when they are writable
+    and have queued requests; there is no polling.  Other threads hand
+    requests over with send(), which wakes the loop up.
 
     Our external API:
 
-    - Member functions get_header(), get_interfaces(), get_local_height(),
-          get_parameters(), get_server_height(), get_status_value(),
-          is_connected(), set_parameters(), stop()
+    - Member functions get_header(), get_interfaces(), get_interface_stats(),
+          get_local_height(), get_parameters(), get_server_height(),
+          get_status_value(), is_connected(), set_parameters(), stop()
+
+    set_parameters(), follow_chain() and stop() can be called from any
+    thread; what they change is applied on the network loop.
     """
 
     def __init__(self, config=None):
@@ -218,8 +266,21 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.requested_chunks = set()
+        # outstanding chunk requests, by index: (interface, owner), where
+        # owner is the interface whose blockchain the chunk is for
+        self.requested_chunks = {}
+        # chunks received and not yet connected, by index:
+        # (interface, owner, data, future)
+        self.verifying_chunks = {}
+        # set while a headers snapshot is imported in the background
+        self.downloading_headers = False
+        self.verification_pool = None
         self.socket_queue = queue.Queue()
+        self.loop = asyncio.SelectorEventLoop()
+        self.connection_pool = ThreadPoolExecutor(max_workers=max(self.num_server, 1))
+        # interfaces registered for write events
+        self.writers = set()
+        self.wakeup_pending = False
         self.start_network(self.protocol, deserialize_proxy(self.config.get('proxy')))
 
     def register_callback(self, callback, events):
@@ -302,11 +363,18 @@ class Network(util.DaemonThread):
     def send_subscriptions(self):
         self.print_error('sending subscriptions to', self.interface.server, len(self.unanswered_requests), len(self.subscribed_addresses))
         self.sub_cache.clear()
-        # Resend unanswered requests
-        requests = self.unanswered_requests.values()
+        # Resend unanswered requests, except those still in flight on
+        # an open interface, like read-only ones fanned out to another
+        # server: their responses are still to come
+        in_flight = set()
+        for interface in self.interfaces.values():
+            in_flight.update(interface.unanswered_requests)
+            in_flight.update(r[2] for r in interface.unsent_requests)
+        requests = self.unanswered_requests
         self.unanswered_requests = {}
-        for request in requests:
-            message_id = self.queue_request(request[0], request[1])
+        for message_id, request in requests.items():
+            if message_id not in in_flight:
+                message_id = self.queue_request(request[0], request[1])
             self.unanswered_requests[message_id] = request
         self.queue_request('server.banner', [])
         self.queue_request('server.donation_address', [])
@@ -357,6 +425,10 @@ class Network(util.DaemonThread):
         '''The interfaces that are in connected state'''
         return list(self.interfaces.keys())
 
+    def get_interface_stats(self):
+        '''Request window and throughput of the connected interfaces'''
+        return dict((server, i.stats()) for server, i in list(self.interfaces.items()))
+
     def get_servers(self):
         out = NetworkConstants.DEFAULT_SERVERS
         if self.irc_servers:
@@ -377,7 +449,9 @@ class Network(util.DaemonThread):
                 self.print_error("connecting to %s as new interface" % server)
                 self.set_status('connecting')
             self.connecting.add(server)
-            c = Connection(server, self.socket_queue, self.config.path)
+            c = TcpConnection(server, self.socket_queue, self.config.path)
+            future = self.connection_pool.submit(c.run)
+            future.add_done_callback(lambda f: self.wakeup())
 
     def start_random_interface(self):
         exclude_set = self.disconnected_servers.union(set(self.interfaces))
@@ -451,6 +525,10 @@ class Network(util.DaemonThread):
         if self.config.get('server') != server or self.config.get('proxy') != proxy_str:
             return
         self.auto_connect = auto_connect
+        # called from the GUI thread
+        self.call_soon(self.apply_parameters, server, protocol, proxy)
+
+    def apply_parameters(self, server, protocol, proxy):
         if self.proxy != proxy or self.protocol != protocol:
             # Restart the network defaulting to the given server
             self.stop_network()
@@ -505,6 +583,10 @@ class Network(util.DaemonThread):
         if interface:
             if interface.server in self.interfaces:
                 self.interfaces.pop(interface.server)
+                self.loop.remove_reader(interface.fileno())
+                if interface in self.writers:
+                    self.writers.remove(interface)
+                    self.loop.remove_writer(interface.fileno())
             if interface.server == self.default_server:
                 self.interface = None
             interface.close()
@@ -572,11 +654,15 @@ class Network(util.DaemonThread):
                 method, params, message_id = request
                 k = self.get_index(method, params)
                 # client requests go through self.send() with a
-                # callback, are only sent to the current interface,
-                # and are placed in the unanswered_requests dictionary
+                # callback, are sent to the current interface or, if
+                # read-only, to any of get_fanout_interfaces(), and are
+                # placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    assert interface == self.interface
+                    if interface != self.interface and not self.check_fanout_response(response, method, params):
+                        interface.print_error("resending to main interface:", method, params)
+                        self.resend_request(message_id, client_req)
+                        continue
                     callbacks = [client_req[2]]
                 else:
                     # fixme: will only work for subscriptions
@@ -641,6 +727,7 @@ class Network(util.DaemonThread):
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -652,6 +739,7 @@ class Network(util.DaemonThread):
             sends = self.pending_sends
             self.pending_sends = []
 
+        fanout = self.get_fanout_interfaces()
         for messages, callback in sends:
             for method, params in messages:
                 r = None
@@ -668,9 +756,56 @@ class Network(util.DaemonThread):
                     util.print_error("cache hit", k)
                     callback(r)
                 else:
-                    message_id = self.queue_request(method, params)
+                    interface = self.pick_interface(fanout) if method in FANOUT_METHODS else None
+                    message_id = self.queue_request(method, params, interface)
                     self.unanswered_requests[message_id] = method, params, callback
 
+    def get_fanout_interfaces(self):
+        '''The interfaces read-only requests can be sent to: the main
+        interface, and those following its blockchain that are not
+        behind it.'''
+        main = self.interface
+        if not self.config.get('request_fanout', True) or main.blockchain is None:
+            return [main]
+        return [i for i in self.interfaces.values()
+                if i is main or (i.mode == 'default' and i.blockchain == main.blockchain
+                                 and i.tip >= main.tip)]
+
+    def pick_interface(self, interfaces):
+        '''The least loaded of interfaces, relative to their request
+        window.'''
+        load = lambda i: (len(i.unanswered_requests) + len(i.unsent_requests)) / i.window
+        return min(interfaces, key=lambda i: (load(i), i is not self.interface))
+
+    def check_fanout_response(self, response, method, params):
+        '''Whether to accept the response to a request that was not sent
+        to the main interface.'''
+        if response.get('error') is not None:
+            return False
+        if method == 'blockchain.scripthash.get_history':
+            # the synchronizer requested it for the status the main
+            # interface sent, which another server may not have yet
+            r = self.sub_cache.get(self.get_index('blockchain.scripthash.subscribe', params))
+            if r and r.get('result') != history_status(response.get('result')):
+                return False
+        elif method == 'blockchain.transaction.get':
+            # the main interface is trusted with the transactions of
+            # the wallet, other servers must send the one asked for
+            try:
+                tx_hash = bitcoin.hash_encode(bitcoin.Hash(util.bfh(response.get('result'))))
+            except BaseException:
+                return False
+            if tx_hash != params[0]:
+                return False
+        return True
+
+    def resend_request(self, message_id, request):
+        '''Send a client request again, to the main interface.  Without
+        one, it is left unanswered for send_subscriptions().'''
+        if self.interface:
+            message_id = self.queue_request(request[0], request[1])
+        self.unanswered_requests[message_id] = request
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
         # Note: we can't unsubscribe from the server, so if we receive
@@ -688,30 +823,52 @@ class Network(util.DaemonThread):
         if server == self.default_server:
             self.set_status('disconnected')
         if server in self.interfaces:
-            self.close_interface(self.interfaces[server])
+            interface = self.interfaces[server]
+            if interface != self.interface:
+                # requests it did not answer go to the main interface
+                message_ids = list(interface.unanswered_requests.keys())
+                message_ids += [r[2] for r in interface.unsent_requests]
+                for message_id in message_ids:
+                    request = self.unanswered_requests.pop(message_id, None)
+                    if request:
+                        self.resend_request(message_id, request)
+            self.close_interface(interface)
             self.notify('interfaces')
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        # chunks requested from server, or being verified for it, go to
+        # other interfaces
+        owners = set()
+        for index, (interface, owner) in list(self.requested_chunks.items()):
+            if interface.server == server:
+                self.requested_chunks.pop(index)
+                owners.add(owner)
+        owners |= self.cancel_verifications([index for index, x in self.verifying_chunks.items()
+                                             if server in (x[0].server, x[1].server)])
+        for owner in owners:
+            if owner.server != server and owner.server in self.interfaces:
+                self.fill_chunk_window(owner)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
         self.add_recent_server(server)
         interface = Interface(server, socket)
+        interface.batch_size = self.config.get('batch_requests', 0)
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
         interface.mode = 'default'
         interface.request = None
         self.interfaces[server] = interface
+        self.loop.add_reader(interface.fileno(), self.on_readable, interface)
         self.queue_request('blockchain.headers.subscribe', [], interface)
         if server == self.default_server:
             self.switch_to_interface(server)
         #self.notify('interfaces')
 
-    def maintain_sockets(self):
-        '''Socket maintenance.'''
-        # Responses to connection attempts?
+    def process_connections(self):
+        '''Responses to connection attempts.'''
         while not self.socket_queue.empty():
             server, socket = self.socket_queue.get()
             if server in self.connecting:
@@ -721,6 +878,10 @@ class Network(util.DaemonThread):
             else:
                 self.connection_down(server)
 
+    def maintain_sockets(self):
+        '''Socket maintenance.'''
+        self.process_connections()
+
         # Send pings and shut down stale interfaces
         # must use copy of values
         for interface in list(self.interfaces.values()):
@@ -755,13 +916,61 @@ class Network(util.DaemonThread):
             if self.config.is_fee_estimates_update_required():
                 self.request_fee_estimates()
 
-    def request_chunk(self, interface, index):
-        if index in self.requested_chunks:
+    def request_chunk(self, interface, index, owner=None):
+        if index in self.requested_chunks or index in self.verifying_chunks:
+            return
+        if self.downloading_headers:
             return
         interface.print_error("requesting chunk %d" % index)
-        self.requested_chunks.add(index)
+        self.requested_chunks[index] = interface, owner or interface
         self.queue_request('blockchain.block.get_chunk', [index], interface)
 
+    def fill_chunk_window(self, owner):
+        '''Keep up to 'chunk_window' chunks of owner's blockchain in
+        flight, spread over the interfaces that can serve them.'''
+        b = owner.blockchain
+        window = self.config.get('chunk_window', 10)
+        pending = [x for x in list(self.requested_chunks.values()) + list(self.verifying_chunks.values())
+                   if x[1] is owner]
+        n = len(pending)
+        load = defaultdict(int)
+        for x in self.requested_chunks.values():
+            load[x[0]] += 1
+        index = (b.height() + 1) // NetworkConstants.CHUNK_SIZE
+        while n < window and index * NetworkConstants.CHUNK_SIZE <= owner.tip:
+            if index not in self.requested_chunks and index not in self.verifying_chunks:
+                end = min((index + 1) * NetworkConstants.CHUNK_SIZE - 1, owner.tip)
+                servers = [i for i in self.interfaces.values()
+                           if i is owner or (i.tip >= end and i.blockchain in [None, b])]
+                interface = min(servers, key=lambda i: (load[i], i is not owner)) if servers else owner
+                self.request_chunk(interface, index, owner)
+                load[interface] += 1
+                n += 1
+            index += 1
+
+    def get_verification_pool(self):
+        if self.verification_pool is None:
+            default = 0 if 'ANDROID_DATA' in os.environ or not SPAWN_POOLS else (os.cpu_count() or 1)
+            n = self.config.get('verification_processes', default)
+            if n:
+                self.print_error("starting %d verification processes" % n)
+                self.verification_pool = new_process_pool(n)
+        return self.verification_pool
+
+    def submit_verification(self, func, *args):
+        pool = self.get_verification_pool()
+        if pool:
+            future = pool.submit(func, *args)
+            # process_verified_chunks() when done
+            future.add_done_callback(lambda f: self.wakeup())
+            return future
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
@@ -772,16 +981,91 @@ class Network(util.DaemonThread):
             return
         index = params[0]
         # Ignore unsolicited chunks
-        if index not in self.requested_chunks:
+        if self.requested_chunks.get(index, (None,))[0] is not interface:
             return
-        self.requested_chunks.remove(index)
-        connect = interface.blockchain.connect_chunk(index, result)
-        if not connect:
+        interface, owner = self.requested_chunks.pop(index)
+        try:
+            data = bytes.fromhex(result)
+        except ValueError:
+            interface.print_error('bad chunk %d' % index)
             self.connection_down(interface.server)
             return
-        # If not finished, get the next chunk
+        # Chunk N only needs the last header of chunk N-1, which may not
+        # be connected yet.  Linkage to the blockchain is checked again
+        # when the chunk is connected.
+        b = owner.blockchain
+        height = index * NetworkConstants.CHUNK_SIZE - 1
+        prev = self.verifying_chunks.get(index - 1)
+        if index == 0:
+            prev_header = None
+        elif height <= b.height():
+            prev_header = b.read_header(height)
+        elif prev is not None:
+            prev_header = blockchain.deserialize_header(prev[2][-bitcoin.HEADER_SIZE:], height)
+        else:
+            prev_header = None
+        future = self.submit_verification(blockchain.verify_chunk, index, data, prev_header,
+                                          NetworkConstants.CHUNK_SIZE,
+                                          NetworkConstants.EQUIHASH_N,
+                                          NetworkConstants.EQUIHASH_K,
+                                          b.get_chunk_checkpoint(index),
+                                          b.get_spot_check())
+        self.verifying_chunks[index] = interface, owner, data, future
+        # Download more chunks while this one is being verified
+        if owner.mode == 'catch_up':
+            self.fill_chunk_window(owner)
+
+    def cancel_verifications(self, indexes):
+        '''Forget the chunks at indexes, received but not connected yet,
+        so that they can be requested again.  Returns their owners.'''
+        owners = set()
+        for index in indexes:
+            interface, owner, data, future = self.verifying_chunks.pop(index)
+            future.cancel()
+            owners.add(owner)
+        return owners
+
+    def process_verified_chunks(self):
+        '''Connect verified chunks to their blockchain, in order.  Chunks
+        that arrived out of order wait for their predecessor.'''
+        for index in sorted(self.verifying_chunks.keys()):
+            if index not in self.verifying_chunks:
+                continue
+            interface, owner, data, future = self.verifying_chunks[index]
+            if not future.done():
+                continue
+            b = owner.blockchain
+            height = index * NetworkConstants.CHUNK_SIZE - 1
+            if height > b.height():
+                continue
+            self.verifying_chunks.pop(index)
+            try:
+                future.result()
+                if index != 0:
+                    header = blockchain.deserialize_header(data[:bitcoin.HEADER_SIZE], height + 1)
+                    if header.get('prev_block_hash') != b.get_hash(height):
+                        raise BaseException("chunk does not connect at height %d" % height)
+            except BaseException as e:
+                interface.print_error('verify_chunk failed', str(e))
+                # the following chunks were verified against this one
+                self.cancel_verifications([i for i, x in self.verifying_chunks.items()
+                                           if i > index and x[1] is owner])
+                self.connection_down(interface.server)
+                if owner.server in self.interfaces:
+                    self.fill_chunk_window(owner)
+                continue
+            interface.print_error("validated chunk %d" % index)
+            b.save_chunk(index, data)
+            self.on_chunk_connected(owner, index)
+
+    def flush_headers(self, force=True):
+        for b in list(self.blockchains.values()):
+            b.flush(force)
+
+    def on_chunk_connected(self, interface, index):
+        # If not finished, get the next chunks
         if interface.blockchain.height() < interface.tip:
-            self.request_chunk(interface, index+1)
+            self.fill_chunk_window(interface)
         else:
             interface.mode = 'default'
             interface.print_error('catch up done', interface.blockchain.height())
@@ -908,7 +1192,7 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // NetworkConstants.CHUNK_SIZE)
+                self.fill_chunk_window(interface)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -925,69 +1209,122 @@ class Network(util.DaemonThread):
                 self.connection_down(interface.server)
                 continue
 
-    def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
+    def on_readable(self, interface):
+        if interface.server not in self.interfaces:
             return
-        rin = [i for i in self.interfaces.values()]
-        win = [i for i in self.interfaces.values() if i.num_requests()]
-        try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
-        except socket.error as e:
-            # TODO: py3, get code from e
-            code = None
-            if code == errno.EINTR:
-                return
-            raise
-        assert not xout
-        for interface in wout:
+        self.process_responses(interface)
+        self.wakeup()
+
+    def on_writable(self, interface):
+        if interface.server in self.interfaces:
             interface.send_requests()
-        for interface in rout:
-            self.process_responses(interface)
+        self.update_writers()
+
+    def update_writers(self):
+        '''Register interfaces with requests to send for write events,
+        and unregister the others.'''
+        for interface in list(self.interfaces.values()):
+            if interface.wants_write():
+                if interface not in self.writers:
+                    self.writers.add(interface)
+                    self.loop.add_writer(interface.fileno(), self.on_writable, interface)
+            elif interface in self.writers:
+                self.writers.remove(interface)
+                self.loop.remove_writer(interface.fileno())
+
+    def wakeup(self):
+        '''Schedule a call to process() on the network loop.  Can be
+        called from any thread; calls are coalesced.'''
+        with self.lock:
+            if self.wakeup_pending:
+                return
+            self.wakeup_pending = True
+        self.call_soon(self.process)
+
+    def call_soon(self, func, *args):
+        '''Schedule a call to func(*args) on the network loop.  Can be
+        called from any thread; the interfaces and the loop's readers
+        and writers must only be touched from the loop.'''
+        try:
+            self.loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+    def process(self):
+        '''Handle everything that other threads, or responses, may have
+        left for the network loop.'''
+        with self.lock:
+            self.wakeup_pending = False
+        if not self.is_running():
+            self.loop.stop()
+            return
+        self.process_connections()
+        self.process_verified_chunks()
+        self.flush_headers(False)
+        self.run_jobs()    # Synchronizer and Verifier
+        self.process_pending_sends()
+        self.update_writers()
+
+    def maintain(self):
+        '''Periodic housekeeping: timeouts, pings, reconnections and
+        thread jobs that have no other event to run on.'''
+        self.maintain_sockets()
+        self.maintain_requests()
+        self.process()
+        self.loop.call_later(MAINTENANCE_INTERVAL, self.maintain)
 
     def init_headers_file(self):
         b = self.blockchains[0]
-        print(b.get_hash(0), NetworkConstants.GENESIS)
-        if b.get_hash(0) == NetworkConstants.GENESIS:
+        filename = b.path()
+        if not os.path.exists(filename):
+            open(filename, 'wb+').close()
+        source = self.config.get('headers_bootstrap', getattr(NetworkConstants, 'HEADERS_URL', None))
+        if not source:
             self.downloading_headers = False
             return
-        filename = b.path()
         def download_thread():
             try:
-                import urllib, socket
-                socket.setdefaulttimeout(30)
-                self.print_error("downloading ", NetworkConstants.HEADERS_URL)
-                urllib.request.urlretrieve(NetworkConstants.HEADERS_URL, filename)
-                self.print_error("done.")
-            except Exception:
+                HeadersBootstrap(b, source).run()
+            except BaseException as e:
                 import traceback
                 traceback.print_exc()
-                self.print_error("download failed. creating file", filename)
-                open(filename, 'wb+').close()
-            b = self.blockchains[0]
-            with b.lock: b.update_size()
-            self.downloading_headers = False
+                self.print_error("headers bootstrap failed", str(e))
+            try:
+                self.loop.call_soon_threadsafe(self.on_headers_bootstrapped)
+            except RuntimeError:
+                # the loop is closed
+                pass
 
+        # the network loop runs meanwhile, but leaves the headers alone
         self.downloading_headers = True
         t = threading.Thread(target = download_thread)
         t.daemon = True
         t.start()
 
+    def on_headers_bootstrapped(self):
+        self.downloading_headers = False
+        for interface in list(self.interfaces.values()):
+            if interface.tip_header:
+                self.on_notify_header(interface, interface.tip_header)
+
     def run(self):
         self.init_headers_file()
-        while self.is_running() and self.downloading_headers:
-            time.sleep(1)
-        while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            self.maintain_requests()
-            self.run_jobs()    # Synchronizer and Verifier
-            self.process_pending_sends()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.maintain)
+        self.loop.run_forever()
         self.stop_network()
+        self.flush_headers()
+        if self.verification_pool:
+            self.verification_pool.shutdown(wait=False)
+        self.connection_pool.shutdown(wait=False)
+        self.loop.close()
         self.on_stop()
 
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup()
+
     def on_notify_header(self, interface, header):
         height = header.get('block_height')
 
@@ -997,7 +1334,7 @@ class Network(util.DaemonThread):
         interface.tip_header = header
         interface.tip = height
 
-        if interface.mode != 'default':
+        if interface.mode != 'default' or self.downloading_headers:
             return
 
         b = blockchain.check_header(header)
@@ -1053,16 +1390,18 @@ class Network(util.DaemonThread):
 
     def follow_chain(self, index):
         blockchain = self.blockchains.get(index)
-        if blockchain:
-            self.blockchain_index = index
-            self.config.set_key('blockchain_index', index)
-            for i in self.interfaces.values():
-                if i.blockchain == blockchain:
-                    self.switch_to_interface(i.server)
-                    break
-        else:
+        if not blockchain:
             raise BaseException('blockchain not found', index)
-
+        self.blockchain_index = index
+        self.config.set_key('blockchain_index', index)
+        # called from the GUI thread
+        self.call_soon(self.switch_to_chain, blockchain)
+
+    def switch_to_chain(self, blockchain):
+        for i in self.interfaces.values():
+            if i.blockchain == blockchain:
+                self.switch_to_interface(i.server)
+                break
         if self.interface:
             server = self.interface.server
             host, port, protocol, proxy, auto_connect = self.get_parameters()
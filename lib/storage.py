@@ -48,6 +48,17 @@ FINAL_SEED_VERSION = 16     # electrum >= 2.7 will set this to prevent
 
 
 
+def journal_path(path):
+    return path + '.journal'
+
+
+def delete_wallet(path):
+    '''Removes a wallet file and its journal.'''
+    os.unlink(path)
+    if os.path.exists(journal_path(path)):
+        os.unlink(journal_path(path))
+
+
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
     otherwise return None.'''
@@ -67,16 +78,22 @@ class WalletStorage(PrintError):
         self.path = path
         self.modified = False
         self.pubkey = None
+        # changes since the last write, as serialized journal operations
+        self.pending = []
+        self.journal_size = 0
+        self.journal_pubkey = None
+        self.snapshot_size = 0
         if self.file_exists():
             with open(self.path, "r") as f:
                 self.raw = f.read()
+            self.snapshot_size = len(self.raw)
             if not self.is_encrypted():
                 self.load_data(self.raw)
         else:
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
-    def load_data(self, s):
+    def load_data(self, s, ec_key=None):
         try:
             self.data = json.loads(s)
         except:
@@ -94,6 +111,10 @@ class WalletStorage(PrintError):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+            # rewrite the whole file as json on the next write
+            self.snapshot_size = 0
+        else:
+            self.load_journal(ec_key)
 
         # check here if I need to load a plugin
         t = self.get('wallet_type')
@@ -125,7 +146,7 @@ class WalletStorage(PrintError):
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
-        self.load_data(s)
+        self.load_data(s, ec_key)
 
     def set_password(self, password, encrypt):
         self.put('use_encryption', bool(password))
@@ -135,30 +156,119 @@ class WalletStorage(PrintError):
         else:
             self.pubkey = None
 
-    def get(self, key, default=None):
+    def journal_path(self):
+        return journal_path(self.path)
+
+    def snapshot_hash(self, s):
+        return hashlib.sha256(s.encode('utf8')).hexdigest()
+
+    def load_journal(self, ec_key):
+        '''Applies the changes written to the journal since the wallet
+        file was last rewritten.  The journal starts with the hash of
+        that file, and is ignored if it does not match, e.g. after the
+        file was saved by a version that does not know the journal.  A
+        truncated last entry, left by an interrupted write, is dropped.'''
+        self.journal_size = 0
+        self.journal_pubkey = self.pubkey if ec_key is None else ec_key.get_public_key()
+        p = self.journal_path()
+        if not os.path.exists(p):
+            return
+        with open(p, 'rb') as f:
+            lines = f.read().split(b'\n')
+        try:
+            header = json.loads(lines[0].decode('utf8'))
+        except ValueError:
+            header = {}
+        if header.get('snapshot') != self.snapshot_hash(self.raw):
+            self.print_error("ignoring stale journal")
+            os.remove(p)
+            return
+        size = len(lines[0]) + 1
+        count = 0
+        # the last element is what follows the last newline
+        for line in lines[1:-1]:
+            try:
+                s = zlib.decompress(ec_key.decrypt_message(line)) if ec_key else line
+                ops = json.loads(s.decode('utf8'))
+            except Exception:
+                break
+            for op in ops:
+                self.apply_op(op)
+            size += len(line) + 1
+            count += 1
+        self.journal_size = size
+        self.print_error("applied %d journal entries" % count)
+
+    def apply_op(self, op):
+        action, key = op[0], op[1]
+        if action == 'put':
+            self.data[key] = op[2]
+        elif action == 'pop':
+            self.data.pop(key, None)
+        elif action == 'set':
+            self.data.setdefault(key, {})[op[2]] = op[3]
+        elif action == 'del':
+            self.data.get(key, {}).pop(op[2], None)
+
+    def get(self, key, default=None, mutable=True):
+        '''Returns a copy of the value of key.  With mutable=False the
+        stored value itself is returned, and must not be modified.'''
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
-            else:
+            elif mutable:
                 v = copy.deepcopy(v)
         return v
 
     def put(self, key, value):
         try:
             json.dumps(key)
-            json.dumps(value)
+            # stored as it will be read back, e.g. with lists for tuples
+            value = json.loads(json.dumps(value))
         except:
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    self.data[key] = value
+                    self.add_ops(key, old, value)
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                self.pending.append(json.dumps(['pop', key]))
+
+    def put_items(self, key, items, removed=()):
+        '''Sets and removes entries of the dictionary stored at key.
+        Unlike put, this costs only as much as the entries changed.'''
+        with self.lock:
+            d = self.data.get(key)
+            if not isinstance(d, dict):
+                d = self.data[key] = {}
+            for k, v in items.items():
+                op = json.dumps(['set', key, k, v])
+                d[k] = json.loads(op)[3]
+                self.pending.append(op)
+            for k in removed:
+                if k in d:
+                    d.pop(k)
+                    self.pending.append(json.dumps(['del', key, k]))
+            if items or removed:
+                self.modified = True
+
+    def add_ops(self, key, old, value):
+        # dictionaries are journaled item by item, unless most items changed
+        if isinstance(old, dict) and isinstance(value, dict):
+            changed = [k for k, v in value.items() if k not in old or old[k] != v]
+            removed = [k for k in old if k not in value]
+            if len(changed) + len(removed) <= len(value) // 2:
+                self.pending.extend(json.dumps(['set', key, k, value[k]]) for k in changed)
+                self.pending.extend(json.dumps(['del', key, k]) for k in removed)
+                return
+        self.pending.append(json.dumps(['put', key, value]))
 
     @profiler
     def write(self):
@@ -171,6 +281,35 @@ class WalletStorage(PrintError):
             return
         if not self.modified:
             return
+        # changes are appended to the journal, until it grows larger
+        # than the wallet file and the whole file is rewritten
+        if os.path.exists(self.path) and self.pubkey == self.journal_pubkey \
+           and self.journal_size + sum(len(x) for x in self.pending) < self.snapshot_size:
+            self.append_journal()
+        else:
+            self.write_snapshot()
+        self.pending = []
+        self.modified = False
+
+    def append_journal(self):
+        line = bytes('[' + ','.join(self.pending) + ']', 'utf8')
+        if self.pubkey:
+            line = bitcoin.encrypt_message(zlib.compress(line), self.pubkey)
+        p = self.journal_path()
+        with open(p, 'r+b' if os.path.exists(p) else 'wb') as f:
+            if self.journal_size == 0:
+                header = {'snapshot': self.snapshot_hash(self.raw)}
+                f.write(bytes(json.dumps(header), 'utf8') + b'\n')
+                self.journal_size = f.tell()
+            # drop whatever an interrupted write left after the last entry
+            f.seek(self.journal_size)
+            f.truncate()
+            f.write(line + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+            self.journal_size = f.tell()
+
+    def write_snapshot(self):
         s = json.dumps(self.data, indent=4, sort_keys=True)
         if self.pubkey:
             s = bytes(s, 'utf8')
@@ -192,8 +331,21 @@ class WalletStorage(PrintError):
             os.remove(self.path)
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
+        self.raw = s
+        self.snapshot_size = len(s)
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
+        self.journal_size = 0
+        self.journal_pubkey = self.pubkey
         self.print_error("saved", self.path)
-        self.modified = False
+
+    def compact(self):
+        '''Rewrites the wallet file with all changes, including those
+        in the journal, so that it can be copied on its own.'''
+        with self.lock:
+            self.write_snapshot()
+            self.pending = []
+            self.modified = False
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -69,6 +69,12 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
+
+    def add_addresses(self, addresses):
+        with self.lock:
+            self.new_addresses.update(addresses)
+        self.network.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
@@ -111,7 +117,7 @@ class Synchronizer(ThreadJob):
         tx_fees = dict(filter(lambda x:x[1] is not None, tx_fees))
         # Note if the server hasn't been patched to sort the items properly
         if hist != sorted(hist, key=lambda x:x[1]):
-            self.network.interface.print_error("serving improperly sorted address histories")
+            self.print_error("server is serving improperly sorted address histories")
         # Check that txids are unique
         if len(hashes) != len(result):
             self.print_error("error: server history has non-unique txids: %s"% addr)
@@ -0,0 +1,383 @@
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import blockchain
+from lib.bitcoin import HEADER_SIZE
+from lib.simple_config import SimpleConfig
+
+
+def make_header(height, prev_hash, bits=0x1f07ffff):
+    return {
+        'version': 4,
+        'prev_block_hash': prev_hash,
+        'merkle_root': os.urandom(32).hex(),
+        'hash_reserved': '00' * 32,
+        'timestamp': 1477641360 + height * 150,
+        'bits': bits,
+        'nonce': os.urandom(32).hex(),
+        'n_solution': base64.b64encode(os.urandom(1344)).decode('utf8'),
+        'block_height': height,
+    }
+
+
+def make_headers(count, start=0, prev_hash='00' * 32, bits=0x1f07ffff):
+    headers = []
+    for height in range(start, start + count):
+        header = make_header(height, prev_hash, bits)
+        prev_hash = blockchain.hash_header(header)
+        headers.append(header)
+    return headers
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir},
+                                   read_system_config_function=lambda: {},
+                                   read_user_config_function=lambda _: {})
+        os.mkdir(os.path.join(self.electrum_dir, 'forks'))
+        open(os.path.join(self.electrum_dir, 'blockchain_headers'), 'wb').close()
+        blockchain.blockchains.clear()
+        self.chain = blockchain.Blockchain(self.config, 0, None)
+        blockchain.blockchains[0] = self.chain
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.electrum_dir)
+
+    def save_headers(self, chain, headers):
+        for header in headers:
+            chain.save_header(header)
+        for b in list(blockchain.blockchains.values()):
+            b.flush()
+
+
+class TestHeader(BlockchainTestCase):
+
+    def test_serialize_roundtrip(self):
+        header = make_header(7, '11' * 32)
+        raw = blockchain.serialize_header(header)
+        self.assertEqual(HEADER_SIZE, len(raw))
+        h = blockchain.deserialize_header(raw, 7)
+        self.assertEqual(header, dict(h))
+        self.assertEqual(h, header)
+        self.assertEqual(raw, blockchain.serialize_header(h))
+        self.assertEqual(blockchain.hash_header(header), blockchain.hash_header(h))
+
+    def test_lazy_solution(self):
+        header = make_header(3, '22' * 32)
+        h = blockchain.deserialize_header(blockchain.serialize_header(header), 3)
+        self.assertEqual(header['timestamp'], h['timestamp'])
+        self.assertNotIn('n_solution', h._fields)
+        self.assertEqual(base64.b64decode(header['n_solution']), h.get_solution())
+        self.assertEqual(header['n_solution'], h.get('n_solution'))
+        self.assertIsNone(h.get('unknown'))
+
+
+class TestHeaderStore(BlockchainTestCase):
+
+    def test_read_header(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(4, self.chain.height())
+        for header in headers:
+            height = header['block_height']
+            self.assertEqual(header, self.chain.read_header(height))
+            self.assertEqual(blockchain.hash_header(header), self.chain.get_hash(height))
+            self.assertEqual(blockchain.serialize_header(header), self.chain.read_raw_header(height))
+        self.assertIsNone(self.chain.read_header(5))
+        self.assertIsNone(self.chain.read_header(-1))
+        self.assertEqual('0' * 64, self.chain.get_hash(5))
+
+    def test_read_after_truncate(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(headers[4], self.chain.read_header(4))
+        other = make_headers(3, 2, blockchain.hash_header(headers[1]))
+        self.chain.write(b''.join(map(blockchain.serialize_header, other)), 2 * HEADER_SIZE)
+        self.assertEqual(4, self.chain.height())
+        self.assertEqual(other[2], self.chain.read_header(4))
+        self.assertEqual(headers[1], self.chain.read_header(1))
+
+
+class TestHashIndex(BlockchainTestCase):
+
+    def index_size(self, chain):
+        return os.path.getsize(chain.hashes_path()) // blockchain.HASH_SIZE
+
+    def test_index_follows_writes(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(5, self.index_size(self.chain))
+        other = make_headers(2, 2, blockchain.hash_header(headers[1]))
+        self.chain.write(b''.join(map(blockchain.serialize_header, other)), 2 * HEADER_SIZE)
+        self.assertEqual(4, self.index_size(self.chain))
+        for header in headers[:2] + other:
+            self.assertEqual(blockchain.hash_header(header), self.chain.get_hash(header['block_height']))
+        self.assertEqual('0' * 64, self.chain.get_hash(4))
+
+    def test_rebuild(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        # lost index
+        os.remove(self.chain.hashes_path())
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(5, self.index_size(chain))
+        # index behind, e.g. after a crash
+        with open(chain.hashes_path(), 'rb+') as f:
+            f.truncate(2 * blockchain.HASH_SIZE)
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(5, self.index_size(chain))
+        # stale index of a replaced headers file
+        with open(chain.hashes_path(), 'rb+') as f:
+            f.seek(4 * blockchain.HASH_SIZE)
+            f.write(b'\0' * blockchain.HASH_SIZE)
+        chain = blockchain.Blockchain(self.config, 0, None)
+        for header in headers:
+            self.assertEqual(blockchain.hash_header(header), chain.get_hash(header['block_height']))
+
+    def test_fork_and_swap(self):
+        headers = make_headers(4)
+        self.save_headers(self.chain, headers)
+        fork_headers = make_headers(3, 2, blockchain.hash_header(headers[1]))
+        fork = self.chain.fork(fork_headers[0])
+        blockchain.blockchains[fork.checkpoint] = fork
+        self.assertEqual(blockchain.hash_header(headers[1]), fork.get_hash(1))
+        self.assertEqual(blockchain.hash_header(fork_headers[0]), fork.get_hash(2))
+        # the fork becomes longer than its parent and takes its place
+        self.save_headers(fork, fork_headers[1:])
+        main = blockchain.blockchains[0]
+        self.assertIs(fork, main)
+        for header in headers[:2] + fork_headers:
+            self.assertEqual(blockchain.hash_header(header), main.get_hash(header['block_height']))
+        branch = blockchain.blockchains[2]
+        self.assertTrue(os.path.exists(branch.hashes_path()))
+        for header in headers[2:]:
+            self.assertEqual(blockchain.hash_header(header), branch.get_hash(header['block_height']))
+            self.assertTrue(branch.check_header(header))
+            self.assertFalse(main.check_header(header))
+
+
+class TestHeaderCache(BlockchainTestCase):
+
+    def test_hits(self):
+        headers = make_headers(3)
+        self.save_headers(self.chain, headers)
+        self.assertEqual(headers[2], self.chain.read_header(2))
+        self.assertIs(self.chain.read_header(2), self.chain.read_header(2))
+        self.chain.get_hash(1)
+        self.chain.get_hash(1)
+        stats = self.chain.get_cache_stats()
+        self.assertEqual({'size': 1, 'hits': 2, 'misses': 1}, stats['headers'])
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1}, stats['hashes'])
+
+    def test_write_invalidates(self):
+        headers = make_headers(4)
+        self.save_headers(self.chain, headers)
+        for height in range(4):
+            self.chain.read_header(height)
+            self.chain.get_hash(height)
+        other = make_headers(2, 2, blockchain.hash_header(headers[1]))
+        self.chain.write(b''.join(map(blockchain.serialize_header, other)), 2 * HEADER_SIZE)
+        self.assertEqual([0, 1], sorted(self.chain.headers_cache.keys()))
+        self.assertEqual([0, 1], sorted(self.chain.hashes_cache.keys()))
+        self.assertEqual(other[1], self.chain.read_header(3))
+        self.assertEqual(blockchain.hash_header(other[1]), self.chain.get_hash(3))
+        # appending keeps what is cached
+        self.save_headers(self.chain, make_headers(1, 4, blockchain.hash_header(other[1])))
+        self.assertIn(3, self.chain.headers_cache)
+
+    def test_swap_invalidates(self):
+        headers = make_headers(3)
+        self.save_headers(self.chain, headers)
+        fork_headers = make_headers(3, 1, blockchain.hash_header(headers[0]))
+        fork = self.chain.fork(fork_headers[0])
+        blockchain.blockchains[fork.checkpoint] = fork
+        self.assertEqual(headers[2], self.chain.read_header(2))
+        self.save_headers(fork, fork_headers[1:])
+        main = blockchain.blockchains[0]
+        self.assertEqual(fork_headers[1], main.read_header(2))
+        self.assertEqual(headers[2], blockchain.blockchains[1].read_header(2))
+
+
+class TestCheckpoints(BlockchainTestCase):
+
+    CHUNK_SIZE = 4
+
+    def chunk(self, headers):
+        return b''.join(map(blockchain.serialize_header, headers))
+
+    def checkpoint(self, headers, root=False):
+        hashes = [bytes.fromhex(blockchain.hash_header(h))[::-1] for h in headers]
+        return (blockchain.hash_header(headers[-1]),
+                blockchain.chunk_hash_root(hashes) if root else None)
+
+    def verify(self, index, headers, prev_header, checkpoint, spot_check=0):
+        blockchain.verify_chunk(index, self.chunk(headers), prev_header, self.CHUNK_SIZE,
+                                200, 9, checkpoint, spot_check)
+
+    def test_hash_linkage(self):
+        headers = make_headers(8)
+        self.verify(1, headers[4:], headers[3], self.checkpoint(headers[4:]))
+        self.verify(1, headers[4:], None, self.checkpoint(headers[4:]))
+        with self.assertRaises(BaseException):
+            self.verify(1, headers[4:], headers[2], self.checkpoint(headers[4:]))
+        with self.assertRaises(BaseException):
+            self.verify(1, headers[4:], headers[3], self.checkpoint(headers[:4]))
+        # a header of another chain in the middle of the chunk
+        other = headers[4:6] + make_headers(2, 6)
+        with self.assertRaises(BaseException):
+            self.verify(1, other, headers[3], self.checkpoint(headers[4:]))
+        with self.assertRaises(BaseException):
+            self.verify(1, headers[4:7], headers[3], self.checkpoint(headers[4:]))
+
+    def test_hash_root(self):
+        headers = make_headers(4)
+        self.verify(0, headers, None, self.checkpoint(headers, root=True))
+        tampered = headers[:3] + [make_header(3, blockchain.hash_header(headers[2]))]
+        checkpoint = (blockchain.hash_header(tampered[3]), self.checkpoint(headers, root=True)[1])
+        with self.assertRaises(BaseException):
+            self.verify(0, tampered, None, checkpoint)
+
+    def test_spot_check(self):
+        # any hash meets this target, but random solutions do not
+        # survive a full verification
+        headers = make_headers(4, bits=0x20ffffff)
+        self.verify(0, headers, None, self.checkpoint(headers))
+        with self.assertRaises(BaseException) as cm:
+            self.verify(0, headers, None, self.checkpoint(headers), spot_check=0.25)
+        self.assertIn('Equihash', str(cm.exception))
+
+    def test_get_checkpoints(self):
+        size = blockchain.NetworkConstants.CHUNK_SIZE
+        headers = make_headers(size * 2 + 3)
+        self.save_headers(self.chain, headers)
+        checkpoints = self.chain.get_checkpoints()
+        self.assertEqual(2, len(checkpoints))
+        self.assertEqual(blockchain.hash_header(headers[2 * size - 1]), checkpoints[1][0])
+        self.assertIsNone(self.chain.get_chunk_checkpoint(1))
+        self.chain.checkpoints = checkpoints
+        self.config.set_key('checkpoint_trust', True)
+        self.assertEqual((checkpoints[1][0], checkpoints[1][2]), self.chain.get_chunk_checkpoint(1))
+        self.assertIsNone(self.chain.get_chunk_checkpoint(2))
+        self.config.set_key('checkpoint_spot_check', 0)
+        data = self.chunk(headers[size:2 * size])
+        self.chain.verify_chunk(1, data)
+        with self.assertRaises(BaseException):
+            self.chain.verify_chunk(0, data)
+
+
+class TestSegments(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestSegments, self).setUp()
+        self.headers = make_headers(6)
+        self.save_headers(self.chain, self.headers)
+        self.fork_headers = make_headers(5, 3, blockchain.hash_header(self.headers[2]))
+        self.fork = self.chain.fork(self.fork_headers[0])
+
+    def check_chain(self, chain, headers):
+        self.assertEqual(headers[-1]['block_height'], chain.height())
+        for header in headers:
+            height = header['block_height']
+            self.assertEqual(header, chain.read_header(height))
+            self.assertEqual(blockchain.hash_header(header), chain.get_hash(height))
+
+    def test_fork_splits_parent(self):
+        self.assertEqual([0, 3], [x.start for x in self.chain.segments])
+        self.assertEqual(3 * HEADER_SIZE, os.path.getsize(self.chain.path()))
+        self.check_chain(self.chain, self.headers)
+        self.check_chain(self.fork, self.headers[:3] + self.fork_headers[:1])
+
+    def test_swap_moves_segments(self):
+        fork_segment = self.fork.segments[0]
+        old_segment = self.chain.segments[1]
+        self.save_headers(self.fork, self.fork_headers[1:])
+        main = blockchain.blockchains[0]
+        self.assertIs(self.fork, main)
+        # no header was copied
+        self.assertEqual(['blockchain_headers', fork_segment.name], [x.name for x in main.segments])
+        self.assertEqual([old_segment], self.chain.segments)
+        self.assertEqual(3, self.chain.checkpoint)
+        self.check_chain(main, self.headers[:3] + self.fork_headers)
+        self.check_chain(self.chain, self.headers)
+        # and back
+        self.save_headers(self.chain, make_headers(3, 6, blockchain.hash_header(self.headers[5])))
+        self.assertIs(self.chain, blockchain.blockchains[0])
+        self.assertEqual(0, self.chain.checkpoint)
+        self.check_chain(self.fork, self.headers[:3] + self.fork_headers)
+
+    def test_write_keeps_boundaries(self):
+        other = make_headers(4, 1, blockchain.hash_header(self.headers[0]))
+        self.chain.write(b''.join(map(blockchain.serialize_header, other)), HEADER_SIZE)
+        self.assertEqual([0, 3], [x.start for x in self.chain.segments])
+        self.check_chain(self.chain, self.headers[:1] + other)
+        # truncating below a boundary drops the segments above it
+        removed = self.chain.segments[1]
+        self.chain.write(blockchain.serialize_header(other[0]), HEADER_SIZE)
+        self.assertEqual([0], [x.start for x in self.chain.segments])
+        self.assertFalse(os.path.exists(removed.path()))
+        self.check_chain(self.chain, self.headers[:1] + other[:1])
+
+    def test_read_blockchains(self):
+        self.save_headers(self.fork, self.fork_headers[1:])
+        segments = [(x.name, x.start) for x in blockchain.blockchains[0].segments]
+        blockchain.blockchains.clear()
+        blockchain.read_blockchains(self.config)
+        main = blockchain.blockchains[0]
+        self.assertEqual(segments, [(x.name, x.start) for x in main.segments])
+        self.check_chain(main, self.headers[:3] + self.fork_headers)
+
+
+class TestWriteBuffer(BlockchainTestCase):
+
+    def test_buffered_headers(self):
+        headers = make_headers(5)
+        for header in headers:
+            self.chain.save_header(header)
+        self.assertEqual(0, os.path.getsize(self.chain.path()))
+        self.assertEqual(4, self.chain.height())
+        for header in headers:
+            self.assertEqual(header, self.chain.read_header(header['block_height']))
+            self.assertEqual(blockchain.hash_header(header), self.chain.get_hash(header['block_height']))
+        self.chain.flush(False)
+        self.assertEqual(0, os.path.getsize(self.chain.path()))
+        self.chain.flush()
+        self.assertEqual(5 * HEADER_SIZE, os.path.getsize(self.chain.path()))
+        self.assertEqual(4, self.chain.height())
+
+    def test_thresholds(self):
+        self.config.set_key('header_write_buffer', 3)
+        headers = make_headers(4)
+        for header in headers:
+            self.chain.save_header(header)
+        self.assertEqual(3 * HEADER_SIZE, os.path.getsize(self.chain.path()))
+        self.config.set_key('header_write_delay', 0)
+        self.chain.flush(False)
+        self.assertEqual(4 * HEADER_SIZE, os.path.getsize(self.chain.path()))
+
+    def test_write_flushes(self):
+        headers = make_headers(4)
+        for header in headers[:3]:
+            self.chain.save_header(header)
+        self.chain.write(blockchain.serialize_header(headers[3]), 3 * HEADER_SIZE)
+        self.assertEqual(4 * HEADER_SIZE, os.path.getsize(self.chain.path()))
+        self.assertEqual(headers[2], self.chain.read_header(2))
+
+    def test_recover(self):
+        headers = make_headers(5)
+        self.save_headers(self.chain, headers)
+        with open(self.chain.path(), 'rb+') as f:
+            # a zeroed header, and a damaged one after it
+            f.seek(3 * HEADER_SIZE)
+            f.write(bytes(HEADER_SIZE) + b'\x01' * 100)
+        chain = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(2, chain.height())
+        self.assertEqual(3 * HEADER_SIZE, os.path.getsize(chain.path()))
+        self.assertEqual(blockchain.hash_header(headers[2]), chain.get_hash(2))
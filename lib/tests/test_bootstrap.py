@@ -0,0 +1,120 @@
+import os
+import threading
+import unittest
+from unittest import mock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from lib import blockchain
+from lib.bitcoin import NetworkConstants, HEADER_SIZE
+from lib.bootstrap import HeadersBootstrap
+
+from .test_blockchain import BlockchainTestCase, make_headers
+
+
+class TestHeadersBootstrap(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestHeadersBootstrap, self).setUp()
+        size = NetworkConstants.CHUNK_SIZE
+        # two checkpointed chunks, then an unverifiable one
+        self.headers = make_headers(3 * size + 5)
+        self.snapshot = os.path.join(self.electrum_dir, 'snapshot')
+        with open(self.snapshot, 'wb') as f:
+            f.write(b''.join(map(blockchain.serialize_header, self.headers)))
+        source = blockchain.Blockchain(self.config, 0, None, [('snapshot', 0)])
+        checkpoints = source.get_checkpoints()[:2]
+        checkpoints[1] = checkpoints[1][:2]
+        self.chain.checkpoints = checkpoints
+        self.config.set_key('checkpoint_trust', True)
+        self.config.set_key('checkpoint_spot_check', 0)
+        self.genesis = NetworkConstants.GENESIS
+        NetworkConstants.GENESIS = blockchain.hash_header(self.headers[0])
+
+    def tearDown(self):
+        NetworkConstants.GENESIS = self.genesis
+        super(TestHeadersBootstrap, self).tearDown()
+
+    def check_imported(self, chunks):
+        size = NetworkConstants.CHUNK_SIZE
+        self.assertEqual(chunks * size - 1, self.chain.height())
+        for height in [0, size - 1, chunks * size - 1]:
+            self.assertEqual(blockchain.hash_header(self.headers[height]), self.chain.get_hash(height))
+
+    def test_local_file(self):
+        self.assertEqual(2, HeadersBootstrap(self.chain, self.snapshot).run())
+        self.check_imported(2)
+        self.assertEqual(0, HeadersBootstrap(self.chain, self.snapshot).run())
+
+    def test_resume(self):
+        with open(self.snapshot, 'rb+') as f:
+            f.truncate(int(1.5 * NetworkConstants.CHUNK_SIZE) * HEADER_SIZE)
+        self.assertEqual(1, HeadersBootstrap(self.chain, self.snapshot).run())
+        self.check_imported(1)
+        with open(self.snapshot, 'ab') as f:
+            f.write(b''.join(map(blockchain.serialize_header, self.headers[int(1.5 * NetworkConstants.CHUNK_SIZE):])))
+        self.assertEqual(1, HeadersBootstrap(self.chain, self.snapshot).run())
+        self.check_imported(2)
+
+    def test_bad_chunk(self):
+        with open(self.snapshot, 'rb+') as f:
+            f.seek(NetworkConstants.CHUNK_SIZE * HEADER_SIZE + 50)
+            f.write(b'\xff')
+        self.assertEqual(1, HeadersBootstrap(self.chain, self.snapshot).run())
+        self.check_imported(1)
+
+    def test_untrusted_checkpoints(self):
+        # checkpoints of another chain, like the testnet placeholders
+        self.chain.checkpoints = [['00' * 32, 0], ['00' * 32, 0]]
+        self.assertEqual(0, HeadersBootstrap(self.chain, self.snapshot).run())
+        self.config.set_key('checkpoint_trust', False)
+        # the synthetic headers have no valid proof of work
+        with mock.patch.object(blockchain, 'verify_chunk') as verify_chunk:
+            self.assertEqual(3, HeadersBootstrap(self.chain, self.snapshot).run())
+        self.check_imported(3)
+        self.assertEqual([None] * 3, [args[6] for args, kwargs in verify_chunk.call_args_list])
+
+    def serve(self, data):
+        gets = []
+        class Handler(BaseHTTPRequestHandler):
+            # ignores the range, like some static file servers
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+            def do_GET(self):
+                gets.append(self.path)
+                self.do_HEAD()
+                self.wfile.write(data)
+            def log_message(self, *args):
+                pass
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d/snapshot' % server.server_port, gets
+
+    def test_url(self):
+        data = open(self.snapshot, 'rb').read()
+        url, gets = self.serve(data)
+        self.chain.save_chunk(0, data[:NetworkConstants.CHUNK_SIZE * HEADER_SIZE])
+        self.assertEqual(1, HeadersBootstrap(self.chain, url).run())
+        self.check_imported(2)
+        self.assertEqual(1, len(gets))
+
+    def test_url_not_behind(self):
+        data = open(self.snapshot, 'rb').read()
+        url, gets = self.serve(data)
+        size = NetworkConstants.CHUNK_SIZE * HEADER_SIZE
+        for index in range(3):
+            self.chain.save_chunk(index, data[index * size:(index + 1) * size])
+        self.assertFalse(HeadersBootstrap(self.chain, url).is_required())
+        self.assertEqual(0, HeadersBootstrap(self.chain, url).run())
+        self.assertEqual([], gets)
+
+    def test_unknown_size(self):
+        bootstrap = HeadersBootstrap(self.chain, 'http://127.0.0.1:1/snapshot')
+        self.assertTrue(bootstrap.is_required())
+        self.chain.save_chunk(0, open(self.snapshot, 'rb').read(NetworkConstants.CHUNK_SIZE * HEADER_SIZE))
+        self.assertFalse(bootstrap.is_required())
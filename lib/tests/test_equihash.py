@@ -0,0 +1,182 @@
+import unittest
+
+from lib import blockchain, equihash
+from lib.equihash import (is_gbp_valid, are_gbp_valid, gbp_validate,
+                          gbp_validate_batch, header_digest)
+
+# (nonce, minimal solution) pairs for n=48, k=5 over HEADER
+HEADER = bytes(range(108))
+SOLUTIONS = [
+    (0, '10b2693a82b7d0c2a63de461fd643639893328a5dd3465d715b12b3353dd4ff644467fb6'),
+    (2, '03e885b5137eba73cd164f93b6b32c16076d102819b28abe1abf8c114888af35a4464b56'),
+    (3, '0bf9830562cfe613de29a51b9c02a6b293bc1452caf9a40c3b1fda374dd83f15caf6e9bb'),
+    (3, '0cc41532d4926e79d5186709cdb1958dc1d90e1a5015b5cbc1aeea14c6261c051d4b2fa1'),
+    (8, '047c0b506606f9f1ad04e48c19f46f4d4f2b060e5472e644e1a3b9553596f4b6dd32d56d'),
+]
+
+# Real (200, 9) headers, with their solutions: (network, height, raw header)
+REAL_HEADERS = [
+    ('mainnet', 1000, bytes.fromhex(
+        '040000006420a42bed28e7e735d562bd7ed65b5869bdbf409eef49eb2ae386eb0a00000080c9a4259ee21aa1cdce5b9d'
+        '788c383e4401f6283d73d0b403e51f90386ea44800000000000000000000000000000000000000000000000000000000'
+        '00000000b1af14588de20f1da555930ac7b20500000000000000000000000000000000000000000000000002fd400500'
+        '3bd1eed8ec2acfb38c728dcffafcc1c10716b2d518119615c95684fd2ee693a7134490f943c17ab4130bcc16663ee266'
+        '67d79f32070d97c426e06f7a94c515ae7fbfd61cc0735eae12a6f6996c213d6691370a0b640f7a6143d431fa21f31c76'
+        '315c9e0d60b6176735fa92942cd54547bba348f7a96dca66677a342b3c0c51677fd113762fc28df66c73ca4762fdd4f7'
+        'f7303e18cd2d3b1e2f3716ec975dacc923fac0e55926dc03490b7b6cceea20c2bab9b2d678fe269ceb580ccb346e65fd'
+        'd84dc0e38bc1660f90f917ce7f21fa10de034f4773500f311fdf4c76c16afd396338eadfd96e046bf70a20ea0cddb0b6'
+        '87d906bf1b6a12db3e411c041aa3d6c40d088b1040f3fd4d229e1a7f0777a3031efb030eee1de2d5bbbc84075972b8da'
+        '18273802150c3c98fc48837784caf905b4556f1133afb65dedf82825852ea5e31bd7a45997a4034168771104f8b34301'
+        '5c1abd0716d10d6bc1f03cb905857dcc56f7e2fc6c1d83762c2065ebfe0d87f289fccbde95715557bb21cd02bc09cc50'
+        '13028a523ab63e490281863e65ca2d7247ff7de13defdf5db5d5db3837723e1758318f062321750bc1c17371475509c3'
+        'e1ef154be46f59551c136f50c06ef29b97930490022d75855cdf18278a185124020a13c2a1de456494a17838c77ede9d'
+        'bfb025234e13b6d7b43cd561e6930fd3a709a5ff4f84dc05ac3ff32b687ed97db3644fb5cd752d4138784fb011fd65ca'
+        'c32a02eb93ad528127f41b494d6079b970399ffbd371ed93d78eaa08d10878bb1b44893d6ad14e5ceeb34ee044d7af10'
+        '56e7ff64984763985ed6e40f42e2470e36af8dd0a87140f7eee9c8940d6e154b27a3db8a10a221e59a2bf42429561b3a'
+        '9c4cfab6f114391b1fd02cf2f3ec4ac77acaf4cc0e9ddcb8b20919584cb11dab8305e76302da779f0d9ef0f358aac902'
+        '270f857d215c032a766183cd27f1a9e4d25f59ac7360f424c82b6ea3dced576ed36c7707184e9cbe760bc953e4444e89'
+        '67e4f0b84808fde99704153f8b2a1b3da14228d8e71d12229734ddddbdf208fc3444840f9bb334d21ae2b58ec0c669e4'
+        'f93e4ec8d659e5d52492daea112423ef4433f40bdfba877db7e7db053515288fd1c4ded1af01c4d60e9bc39e6e78f9b9'
+        'c6628beb1d7064e5c79fdb8a5a77ef78185aa822d95caf0ae776abd3cc813266ba93b58853e6cf637c7fb865164b1c58'
+        'e665ecbbacd381b8c7fee0da7a21f6bd6e0f43f95c85e9fb6bbc59db59d4ef23fb7a821f04a50f79aa14ee862e36f671'
+        'b5e3733b733ef2b69ecd880d843a3ea7864d134a6f32b502ac549ee2aebb2bde0e9826a971d7ce4d7937940468bb9491'
+        '7bcff560d33e9b04434cd9ce8edb5e370afedc34b3bcbd1de6c04cbc242f679e7916fc4da54f7e609ffe32b41d43d504'
+        '4816d3b7cac77e78df188723574b5a62f6b7faf2263c0f3a469d683dba34087691f10dba3e745408d917ec5324072f2e'
+        '5dc5a743d27d78b1590389ab54091809791df5e15ef9472c71886328856883ff49739707a0d8fcf2707d47864d85e165'
+        '62ae8666a018ee4210f203fd98096584908d740ccc794b3aa48017f75f1e02a368698bd049faf62a4c8efda1838f295f'
+        '88c741626fafa9de9dc17d75a6d1cf6256929fd6589fa00655dbdb41e3cb0b63e523d18fbb8662c14e777dae0bfe6a91'
+        '618aa4f744b452e580a47c6a78f75dfcb425f399ebf06de31fe4f8252fddbdc48a97d6dc43484cb775f9f617945ffe7e'
+        '181498c153de17f0bbc2fa0eac18e201a00145e64a02a7bfa866a166b45857281683ae34bb8e4bbe96a8b2305117169a'
+        '2afed309921554bc551bcc9aac9488b28af5e10321ce53101e79348b3d200e8e3564d78084c017a6239a3dee765ebf')),
+    ('testnet', 242100, bytes.fromhex(
+        '040000006a85cea670394c3e50ffcbe43e5fd984d2cd5e9d0c5a5c1b028d12666a040500ea30b934e0fe3044c36b0bd3'
+        '89d9c2bc708535bf074063c49d5edc484ed8b11b00000000000000000000000000000000000000000000000000000000'
+        '00000000e0af085befa2161f21c8c5662bb76c280f0100000000000000000002000000000000000000000000fd400500'
+        'bf922789d97f61de67612b5dacc6d5748793a6d12b053ec33fa254896ea6836623f2845cf943ef280d055f7507c9486d'
+        'f48175a71bb6db4fc61df230f19b07c68195b6e716b9c70292e3a9b081ba975fbee8c5092d4d9f8674abf9ea1d6099eb'
+        '68e3fe1699d793800bd071f9d6cb77a3cc0592e241c6fb518201fdfad81c05c234c61541aff387546faaf69951782370'
+        'f8381dbb813e9c226c9db371f569ba33ea8f3d811ae73000f7079ebc54885ccc08ba7b9aefa24323cd1f55f40bdf3575'
+        'a48882ac6de131c7e5d3cb48af50eb1bbe0c3098e271af3f73f96e02a3e05265e308be3a42e5225f9a02c769d085dda5'
+        '489f8ed506b257eb75fd9a07bb4f0d95d9942334c930a2e0bb4f88cc94bde32f37ef5de6fda9c495b92ce6120cb5cdae'
+        'd53afe5fb6093c6a67be1894c74f05f0a72998eedc79c1640cec5b44a70b8371cd19c68e4625eb3625ce2452b166e501'
+        '18673d489cf1a3f1cbb44362e654ed711b5537a5144dda1eddae79efa04af70441bde5375e7c3e8b040a5c223449503f'
+        '8c83aa62bc1e64d6d6c196fa89e125631a84c1db0e57ce8632ad931c76758ee9ff5bdd0777c40aa317dea73e55411471'
+        'cde0448762319fbb220e01c331c98962500ab61cc3ef935de02119d09f596aa66b4db16ed7a988f867114c511a232c92'
+        '1d19688813792432ec83c65368ce82d7868a846cb7dc000540268fe78633d28362e202c721ca9b3cb5fb8ad1132dceb6'
+        '5a98083b77f8f4c033a7794d36d95864ed0a53f5458b84c2b5f9c9023a734f6f0238d4d84c400e1f5484de69221b6eb4'
+        '03e018714ff2af67986a610a0f4c565630d03fbd78f14b0f256e414d5ff938f443806543afaa749d9335c69d1fbf3007'
+        '5158fc709b0c417460ce11d82aa816f31da6fc67458b26f9809c0eb299ea6c963bc386d5646d985a87ba46b57eeb7c01'
+        'e2125dfd04a088ec8ce12db7187c9dfaded3f10b09287bde838fba591039517d33af8afc90d8a5bbed11bf8c27995f66'
+        '91455531d4d17bbe823d4bfe79dc35caafb9015847179248d6988d6a83fe1d633ac681030ef8ec25c56c473948905b56'
+        '349ef99a827538ca1b9c3f56741b06034708a596a4c07ec6c98ff889a736ce5301159cf67ba349c64a9475c99f261afc'
+        'a4a540fb7f240bfbcbcfe6efe64e75d7376dea705b083403771143d69399b126ba6300f9e61d0e415cb4eb2a0a6eb40d'
+        'aa4bb4e1dfaa0333ad205a2e3cf298f8300c82c91c6b6981bfbf6a212809de2953a32c3f21632764132b3250543fd554'
+        'a387a765ecf5c0b8590d0006620a1827a166a9cc83a449fe74ed0f60dc3fda5b0aa07e555863e98327ee86f94ce13e0a'
+        'dda7df5eff0b84954359dfee63018010c4168e7d5f08b39a8a49230d1976b5e5153981ffc30205ce5e1eb6a0f66d4402'
+        '9014882dc1790b20cb3043f213afa148fb4fb3e8245b9d5195b045e1c2e69305d9dbc04cd7550b6f6e106d4634016884'
+        '857a8ec1cc809195354b8edf7d3c3d70aef924b64157dc89782c6a7ef5be5af25a0f3209931efd9210d907b76963c106'
+        'ce40ca535832d2aa438b2c67b72ac5fde96cfce56d6f6aeb64d97c24860a4e57ffc5c63873e9b6c29b9467db90ffb351'
+        'd99023ec6a9a35a0920193b0c2aaaa23ade694cbdc854f03e8d0d847e2d85f78a9e45c2d728735331ace64653d56eee2'
+        'e8e9accfa95c962d2ff194b1fe025dd42809c81618f11facab06f1a5793ad8cadd8f41fdaca8116039346ea49d37c17a'
+        '06abee434881cce3154b0e11cc06b9d7976a86dd47750731b385f2b4e11f305f23c37b9dfb149e99d4108299a9b4e725'
+        'fd675f15e5242baf37138bee358963c347964368016404f467142d7159a4a5117fe7ef08376a39fb240e57243b0d92')),
+    ('testnet', 283046, bytes.fromhex(
+        '0400000024aaa65ca5b8782e313843192d5f9c3e31f63f956501d01374c59777dd8b020021c86589715b95bafa0174dc'
+        '94dd1878d079200793b15d834d7924ccd67388888e237da776e7b2209e994340db5cb6124351b503e52943ea095df5f2'
+        'b93385322a40895b831e101f9a00829c15019af3451d3e402110392490ca7bb4bb3c19af2ac4c34bfa8b0000fd400500'
+        '1e3c11c2a45123afb3e96715d03aa6e3127b0bb225499523d710dc893d3bf2c1f334794cc3fe8d80fe0881e1d7b9d4a3'
+        '86dd47b0d051d5f8e6158755b52d3af9dad1ae974c2b978156a687bd21c62f6ad49ee9040c295406602a6d1cf482a03e'
+        '7924f12544134135153c3779202b31cbeacfb2c943b7b98b0d795a622f15b14a82948a2db4f2bb0a3d937427af7c2f5d'
+        '3ff231bf1da5469c3dafc8c8489be3f5803fb923bf27760e7fe52dddafa581af7494c46d72870ab68ff5e0654d312fc3'
+        '7ce17ded3fd9360dccb3b139a4e09e59990f0cb707640849496eaf856acd424107a6377dfea63967abb4425289139395'
+        'c54e1330d9625075d96c221911e4b2629f62afad84048d3a55a91deea95322b41b4fb165eee79b75a240522496128d0c'
+        'd6905e93f42dba2efe3b6cf6276be533b068f7f379533a9d16ce622f048a1b1f1feb8c16b83bd9dd52f76d78fe7f7d01'
+        '6740e2bef9c135fe83e1b889f269fdb77433ab4f15c4a9010517ac156246150c923f641e0b3c9702f10784dde19a43e5'
+        '211992765c5841ab51adaed4177e0f8291eeba12d600d3d803d7cec09e2947cf5c188805a6147490c19c81368291fcb1'
+        'd971c66cb8d5a612494b7e9d4895e6f9563b7a52a07a22035a037ba03f186a7cac5ba44b699bbcb1fc067c0841a571bd'
+        'a4b623fb24e4fa2db4737304e4caf17bdf6ec0013af28a03ce1c75b98cc6f5acf242b355a41187218b3d98781026c8be'
+        '15eb0069a5e642554cea1a590ccdfa425a0c62d9ca05596fbf92c511135f32e4e9b018b3f0f624de86dd5d7bfcbdf053'
+        '072bddda2e45d498b286780f79fa3890b33a7bb120e77e2feaf376c85a7802642db0a6670dd735dd8f1602f5ad37eaa0'
+        'cdfa780ef91b26598f122a5f17ca8b763a636e622a24c5bc44b04891cfcd5d9228ab5635266a1a3be239e70a1784d905'
+        '673bee5555c8bd7e08b452d05792f9b328fce2cd198fce244b89e03987bd12a41bd5ec0aeb3f3bd5342765372b49dbe0'
+        '0fb1e3347fea7abb2dde3691b3a32d4afb4ec9528f94d9628797cc3d0e7dfffb33af2d0d219f3188b713b5e4dad11edd'
+        '407e28f8b8ec4904281fb40840a22e7b9ec0868ade467cd6890cdef721499a63a4401f6e4be95a251644f31d75a9da11'
+        'ed954ac2840b0b59792db113e63dd7d09179b5a437dac5097bf7b5418ed871448c51f74c186d662a8e993afb0ba90902'
+        '5cb011698bb831035b3fc66ef86bfa947b09dabeb1a3ac63fdb3891524e86630361bceb58c3a2e725a4ae49d6f4d7c13'
+        '44993d6644c6970bdca50e099e65ae0e89d3389113528bdb1b42d8bcd2923d803fd9ba493452319761c3f42031ccd7c1'
+        '655055d90d142061b0758a34d6ebaed959c0fa6dafac86be20ed1fe20f26e3312833af5c75479ebe4a2d556b12b0e709'
+        'ef7351ebcad944952c760a57d76619d5a72f0af94ccd7ed05d1b5b974067b8409cceb7da871e99a9550d793cabf0e03f'
+        '0bc54a40e1d45fb71fb40eff2e6d0fa7c994c086a5c1afda32c3fcc62854bff62e19871679922ea6cfa2dfffc9d8764d'
+        '43e162ce3d7ede0e1c56cd625dc92aab124955bdc4c56d15a26f9da23225f5a2e22f4c5c773afcb2dcf4e0dceee183fd'
+        'ab88291b16bea9a952837df075e439759f55cc05b80d440b637a3bfcccf2194daf02581278594676efdbadac0f098ac5'
+        '3299756b6b89357e6f7d0419ad55f6527b0e1763c0c3e3c2737be3e319dade3525aeedefc806683064bafc69c21b5458'
+        '37472abea915f41ab3d7d826bb22e6eedc128736b6928c7b9ffa3366633fbde03546fa3c36f2e9fdc81e0500f1c8a6cd'
+        'ee3b121d11332769bd7db2dae1b19e24e856cfb8fd99ccbcc6953f9d44e1c1eab607f600c42ce171b92f2cc3799fcb')),
+]
+
+
+class TestEquihash(unittest.TestCase):
+
+    def _inputs(self):
+        nonces = [nonce for nonce, sol in SOLUTIONS]
+        solutions = [bytes.fromhex(sol) for nonce, sol in SOLUTIONS]
+        return nonces, solutions
+
+    def _corrupted(self, solutions):
+        out = []
+        for i, sol in enumerate(solutions):
+            sol = bytearray(sol)
+            sol[i * 7 % len(sol)] ^= 1 << (i % 8)
+            out.append(bytes(sol))
+        return out
+
+    def test_valid_solutions(self):
+        nonces, solutions = self._inputs()
+        for nonce, sol in zip(nonces, solutions):
+            self.assertTrue(is_gbp_valid(HEADER, nonce, sol, 48, 5))
+        self.assertEqual([True] * len(solutions),
+                         are_gbp_valid([HEADER] * len(solutions), nonces, solutions, 48, 5))
+
+    def test_batch_matches_single(self):
+        nonces, solutions = self._inputs()
+        # wrong nonce, flipped bits, truncated solution
+        cases = list(zip(nonces, solutions))
+        cases += [(nonce + 1, sol) for nonce, sol in zip(nonces, solutions)]
+        cases += list(zip(nonces, self._corrupted(solutions)))
+        cases += [(nonces[0], solutions[0][:-1])]
+        digests = [header_digest(HEADER, nonce, 48, 5) for nonce, sol in cases]
+        expected = [gbp_validate(d.copy(), sol, 48, 5) for d, (nonce, sol) in zip(digests, cases)]
+        self.assertEqual(expected, gbp_validate_batch(digests, [sol for nonce, sol in cases], 48, 5))
+        self.assertEqual(len(solutions), sum(expected))
+
+    def test_batch_without_numpy(self):
+        nonces, solutions = self._inputs()
+        np, equihash.np = equihash.np, None
+        try:
+            result = are_gbp_valid([HEADER] * 2, nonces[:2], [solutions[0], solutions[0]], 48, 5)
+        finally:
+            equihash.np = np
+        self.assertEqual([True, False], result)
+
+    def test_empty_batch(self):
+        self.assertEqual([], are_gbp_valid([], [], [], 200, 9))
+
+    def test_real_headers(self):
+        inputs = [blockchain.get_equihash_input(blockchain.deserialize_header(raw, height))
+                  for network, height, raw in REAL_HEADERS]
+        cases = list(inputs)
+        for i, (header, nonce, sol) in enumerate(inputs):
+            # another timestamp, a flipped bit, the next header's solution
+            timestamp = bytes([header[100] ^ 1])
+            cases.append((header[:100] + timestamp + header[101:], nonce, sol))
+            cases.append((header, nonce, self._corrupted([sol])[0]))
+            cases.append((header, nonce, inputs[(i + 1) % len(inputs)][2]))
+        digests = [header_digest(header, nonce, 200, 9) for header, nonce, sol in cases]
+        solutions = [sol for header, nonce, sol in cases]
+        expected = [True] * len(inputs) + [False] * (len(cases) - len(inputs))
+        self.assertEqual(expected, gbp_validate_batch([d.copy() for d in digests], solutions, 200, 9))
+        np, equihash.np = equihash.np, None
+        try:
+            self.assertEqual(expected, gbp_validate_batch(digests, solutions, 200, 9))
+        finally:
+            equihash.np = np
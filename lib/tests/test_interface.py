@@ -1,3 +1,6 @@
+import json
+import socket
+import time
 import unittest
 
 from lib import interface
@@ -24,3 +27,105 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+
+class TestInterfaceRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.interface = interface.Interface('localhost:50001:t', self.a)
+        self.server = self.b.makefile('rb')
+
+    def tearDown(self):
+        self.server.close()
+        self.a.close()
+        self.b.close()
+
+    def queue_requests(self, n):
+        for i in range(n):
+            self.interface.queue_request('blockchain.transaction.get', ['%064x' % i], i)
+        self.assertTrue(self.interface.send_requests())
+
+    def reply(self, message):
+        self.b.sendall((json.dumps(message) + '\n').encode('utf8'))
+
+    def test_single_requests(self):
+        self.queue_requests(3)
+        for i in range(3):
+            request = json.loads(self.server.readline().decode('utf8'))
+            self.assertEqual({'method': 'blockchain.transaction.get',
+                              'params': ['%064x' % i], 'id': i}, request)
+            self.reply({'id': i, 'result': 'tx%d' % i})
+        self.reply({'method': 'blockchain.headers.subscribe', 'params': [{}]})
+        responses = self.interface.get_responses()
+        self.assertEqual([0, 1, 2, None], [r[0] and r[0][2] for r in responses])
+        self.assertEqual({}, self.interface.unanswered_requests)
+
+    def test_batch_requests(self):
+        self.interface.batch_size = 10
+        self.interface.window = 100
+        self.queue_requests(25)
+        batches = [json.loads(self.server.readline().decode('utf8')) for i in range(3)]
+        self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+        requests = sum(batches, [])
+        self.assertEqual(list(range(25)), [r['id'] for r in requests])
+        self.assertTrue(all(r['jsonrpc'] == '2.0' for r in requests))
+        for batch in batches:
+            self.reply([{'jsonrpc': '2.0', 'id': r['id'], 'result': r['params'][0]}
+                        for r in reversed(batch)])
+        responses = self.interface.get_responses()
+        self.assertEqual(25, len(responses))
+        for request, response in responses:
+            self.assertEqual(request[2], response['id'])
+            self.assertEqual(request[1][0], response['result'])
+        self.assertEqual({}, self.interface.unanswered_requests)
+
+    def test_window(self):
+        i = self.interface
+        self.queue_requests(50)
+        self.assertEqual(i.initial_window, len(i.unanswered_requests))
+        self.assertEqual(0, i.num_requests())
+        for n in range(10):
+            self.reply({'id': n, 'result': None})
+        self.assertEqual(10, len(i.get_responses()))
+        # slow start: one more per response
+        self.assertEqual(2 * i.initial_window, i.window)
+        self.assertEqual(2 * i.initial_window, i.num_requests())
+        stats = i.stats()
+        self.assertEqual(10, stats['responses'])
+        self.assertEqual(0, stats['in_flight'])
+        self.assertEqual(40, stats['queued'])
+
+    def test_unsent_request(self):
+        # a request added to unanswered_requests without send_requests
+        self.interface.unanswered_requests[7] = ('server.version', [], 7)
+        self.reply({'id': 7, 'result': 'x'})
+        self.assertEqual(1, len(self.interface.get_responses()))
+        self.assertEqual(0, self.interface.stats()['responses'])
+
+    def test_window_decrease(self):
+        i = self.interface
+        i.window = 64
+        now = time.time()
+        i.on_response(now - 10, False)
+        self.assertEqual(32, i.window)
+        # requests sent before the decrease do not decrease it again
+        i.on_response(now - 10, True)
+        self.assertEqual(32, i.window)
+        self.assertEqual(1, i.stats()['errors'])
+        # congestion avoidance: about one more per window of responses
+        for n in range(33):
+            i.on_response(time.time(), False)
+        self.assertEqual(33, int(i.window))
+        i.on_response(time.time(), True)
+        self.assertEqual(16, int(i.window))
+        for n in range(10):
+            i.last_decrease = 0
+            i.on_response(time.time(), True)
+        self.assertEqual(i.min_window, i.window)
+
+    def test_batch_error(self):
+        self.interface.batch_size = 10
+        self.queue_requests(2)
+        self.reply({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600}})
+        self.assertEqual([(None, None)], self.interface.get_responses())
@@ -0,0 +1,288 @@
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from lib import blockchain, network
+from lib.bitcoin import NetworkConstants, Hash, hash_encode
+from lib.interface import Interface
+from lib.simple_config import SimpleConfig
+from lib.util import set_verbosity
+
+
+class NetworkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        set_verbosity(False)
+        self.user_dir = tempfile.mkdtemp()
+        config = SimpleConfig({'electrum_path': self.user_dir, 'oneserver': True, 'nossl': True,
+                               'server': '127.0.0.1:1:t', 'auto_connect': False})
+        self.network = network.Network(config)
+        self.blockchain = mock.Mock()
+        self.blockchain.height.return_value = NetworkConstants.CHUNK_SIZE - 1
+        self.sockets = []
+        self.a = self.add_interface('a:50001:t')
+        self.b = self.add_interface('b:50001:t')
+
+    def tearDown(self):
+        self.network.connection_pool.shutdown()
+        self.network.loop.close()
+        for s in self.sockets:
+            s.close()
+        shutil.rmtree(self.user_dir)
+
+    def add_interface(self, server):
+        s1, s2 = socket.socketpair()
+        self.sockets.append(s2)
+        interface = Interface(server, s1)
+        interface.blockchain = self.blockchain
+        interface.tip_header = None
+        interface.tip = 5 * NetworkConstants.CHUNK_SIZE
+        interface.mode = 'default'
+        interface.request = None
+        self.network.interfaces[server] = interface
+        return interface
+
+
+class TestChunkRequests(NetworkTestCase):
+
+    def setUp(self):
+        super(TestChunkRequests, self).setUp()
+        self.a.mode = 'catch_up'
+
+    def verifying(self, index, interface, owner, result=None, exception=None):
+        future = Future()
+        if exception:
+            future.set_exception(exception)
+        elif result:
+            future.set_result(result)
+        self.network.verifying_chunks[index] = interface, owner, b'', future
+        return future
+
+    def test_connection_down_while_verifying(self):
+        future = self.verifying(2, self.b, self.a)
+        self.verifying(3, self.a, self.a)
+        self.network.requested_chunks[4] = self.b, self.a
+        self.network.connection_down(self.b.server)
+        self.assertTrue(future.cancelled())
+        self.assertEqual([3], list(self.network.verifying_chunks))
+        # the chunks from b are requested again, from a
+        self.assertEqual((self.a, self.a), self.network.requested_chunks[2])
+        self.assertEqual((self.a, self.a), self.network.requested_chunks[4])
+
+    def test_owner_down_while_verifying(self):
+        self.verifying(2, self.a, self.b)
+        self.network.connection_down(self.b.server)
+        self.assertEqual({}, self.network.verifying_chunks)
+        self.assertNotIn(2, self.network.requested_chunks)
+
+    def test_failed_verification(self):
+        self.verifying(1, self.b, self.a, exception=BaseException('bad chunk'))
+        future = self.verifying(2, self.a, self.a)
+        self.network.process_verified_chunks()
+        self.assertTrue(future.cancelled())
+        self.assertEqual({}, self.network.verifying_chunks)
+        self.assertNotIn(self.b.server, self.network.interfaces)
+        self.assertEqual((self.a, self.a), self.network.requested_chunks[1])
+        self.assertEqual((self.a, self.a), self.network.requested_chunks[2])
+
+    @unittest.skipUnless(network.SPAWN_POOLS, "needs Python 3.7")
+    def test_spawned_pool(self):
+        pool = network.new_process_pool(1)
+        try:
+            self.assertEqual('spawn', pool._mp_context.get_start_method())
+            self.assertEqual('0' * 64, pool.submit(blockchain.hash_header, None).result(timeout=60))
+        finally:
+            pool.shutdown()
+
+    def test_headers_bootstrap(self):
+        self.network.downloading_headers = True
+        self.network.request_chunk(self.b, 1)
+        self.assertEqual({}, self.network.requested_chunks)
+        header = {'block_height': 7}
+        with mock.patch.object(network.blockchain, 'check_header', return_value=self.blockchain) as check:
+            # the tip is recorded, but the headers are left alone
+            self.network.on_notify_header(self.b, header)
+            self.assertEqual(7, self.b.tip)
+            self.assertFalse(check.called)
+            self.network.on_headers_bootstrapped()
+            check.assert_called_once_with(header)
+        self.assertFalse(self.network.downloading_headers)
+
+
+class TestSendSubscriptions(NetworkTestCase):
+
+    def test_fanned_out_not_resent(self):
+        callback = mock.Mock()
+        fanned_out = 'blockchain.transaction.get', ['aa'], callback
+        lost = 'blockchain.transaction.get', ['bb'], callback
+        message_id = self.network.queue_request(fanned_out[0], fanned_out[1], self.b)
+        self.network.unanswered_requests[message_id] = fanned_out
+        # sent to the main interface, which went down
+        self.network.unanswered_requests[1000] = lost
+        self.network.interface = self.add_interface('c:50001:t')
+        self.network.send_subscriptions()
+        self.assertEqual(fanned_out, self.network.unanswered_requests[message_id])
+        self.assertEqual([fanned_out, lost], sorted(self.network.unanswered_requests.values()))
+        sent = [r[:2] for r in self.network.interface.unsent_requests]
+        self.assertIn(lost[:2], sent)
+        self.assertNotIn(fanned_out[:2], sent)
+        self.assertEqual(1, len(self.b.unsent_requests))
+
+
+class TestFanout(NetworkTestCase):
+
+    def setUp(self):
+        super(TestFanout, self).setUp()
+        self.network.interface = self.a
+
+    def test_fanout_interfaces(self):
+        self.assertEqual({self.a, self.b}, set(self.network.get_fanout_interfaces()))
+        # behind the main interface
+        self.b.tip -= 1
+        self.assertEqual([self.a], self.network.get_fanout_interfaces())
+        self.b.tip += 1
+        # following another chain
+        self.b.blockchain = mock.Mock()
+        self.assertEqual([self.a], self.network.get_fanout_interfaces())
+        self.b.blockchain = self.blockchain
+        self.b.mode = 'catch_up'
+        self.assertEqual([self.a], self.network.get_fanout_interfaces())
+        self.b.mode = 'default'
+        self.network.config.set_key('request_fanout', False, False)
+        self.assertEqual([self.a], self.network.get_fanout_interfaces())
+
+    def test_pick_interface(self):
+        interfaces = [self.b, self.a]
+        # the main interface when equally loaded
+        self.assertIs(self.a, self.network.pick_interface(interfaces))
+        self.network.queue_request('server.version', [], self.a)
+        self.assertIs(self.b, self.network.pick_interface(interfaces))
+        # load is relative to the window
+        self.network.queue_request('server.version', [], self.b)
+        self.network.queue_request('server.version', [], self.b)
+        self.assertIs(self.a, self.network.pick_interface(interfaces))
+        self.b.window *= 4
+        self.assertIs(self.b, self.network.pick_interface(interfaces))
+
+    def test_check_fanout_response(self):
+        check = self.network.check_fanout_response
+        self.assertFalse(check({'error': 'busy', 'result': None}, 'blockchain.transaction.get_merkle', ['aa', 1]))
+        self.assertTrue(check({'result': {}}, 'blockchain.transaction.get_merkle', ['aa', 1]))
+        # the history must match the status sent by the main interface
+        history = [{'tx_hash': 'aa', 'height': 1}]
+        method = 'blockchain.scripthash.get_history'
+        self.network.sub_cache[self.network.get_index('blockchain.scripthash.subscribe', ['h'])] = \
+            {'result': network.history_status(history)}
+        self.assertTrue(check({'result': history}, method, ['h']))
+        self.assertFalse(check({'result': history + [{'tx_hash': 'bb', 'height': 2}]}, method, ['h']))
+        # the transaction must be the one asked for
+        raw = '0100000000'
+        tx_hash = hash_encode(Hash(bytes.fromhex(raw)))
+        method = 'blockchain.transaction.get'
+        self.assertTrue(check({'result': raw}, method, [tx_hash]))
+        self.assertFalse(check({'result': raw + '00'}, method, [tx_hash]))
+        self.assertFalse(check({'result': 'not hex'}, method, [tx_hash]))
+        self.assertFalse(check({'result': None}, method, [tx_hash]))
+
+    def test_connection_down_resends(self):
+        request = 'blockchain.transaction.get', ['aa'], mock.Mock()
+        message_id = self.network.queue_request(request[0], request[1], self.b)
+        self.network.unanswered_requests[message_id] = request
+        self.network.connection_down(self.b.server)
+        self.assertNotIn(self.b.server, self.network.interfaces)
+        self.assertNotIn(message_id, self.network.unanswered_requests)
+        (new_id, resent), = self.network.unanswered_requests.items()
+        self.assertEqual(request, resent)
+        self.assertEqual([(request[0], request[1], new_id)],
+                         [tuple(r) for r in self.a.unsent_requests])
+
+
+class TestLoop(NetworkTestCase):
+
+    def setUp(self):
+        super(TestLoop, self).setUp()
+        self.network.interface = self.a
+        # the loop is woken up once the connection attempt of the
+        # network fails; get it over with
+        self.network.connection_pool.shutdown()
+        self.run_loop(0)
+        self.assertFalse(self.network.wakeup_pending)
+
+    def run_loop(self, seconds=0.2):
+        self.network.loop.call_later(seconds, self.network.loop.stop)
+        self.network.loop.run_forever()
+
+    def test_wakeup(self):
+        with mock.patch.object(self.network, 'process') as process:
+            threads = [threading.Thread(target=self.network.wakeup) for i in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.run_loop()
+        # coalesced into one call
+        self.assertEqual(1, process.call_count)
+
+    def test_on_writable(self):
+        self.network.queue_request('server.version', [], self.b)
+        self.network.update_writers()
+        self.assertEqual({self.b}, self.network.writers)
+        self.run_loop()
+        self.assertEqual(set(), self.network.writers)
+        self.assertEqual({'method': 'server.version', 'params': [], 'id': 0},
+                         json.loads(self.sockets[1].recv(1000).decode('utf8')))
+
+    def test_on_writable_full_socket(self):
+        params = ['ab' * 100000]
+        self.b.window = 20
+        for i in range(20):
+            self.network.queue_request('blockchain.transaction.broadcast', params, self.b)
+        self.network.update_writers()
+        self.run_loop()
+        # waits for the peer to read the rest
+        self.assertTrue(self.b.pipe.unsent)
+        self.assertEqual({self.b}, self.network.writers)
+        peer = self.sockets[1]
+        peer.setblocking(False)
+        data = b''
+        while self.network.writers:
+            try:
+                data += peer.recv(65536)
+            except BlockingIOError:
+                pass
+            self.run_loop(0.01)
+        self.assertEqual(b'', self.b.pipe.unsent)
+        try:
+            while True:
+                data += peer.recv(65536)
+        except BlockingIOError:
+            pass
+        self.assertEqual(list(range(20)), [json.loads(line)['id'] for line in data.decode('utf8').splitlines()])
+
+    def test_on_readable(self):
+        callback = mock.Mock()
+        request = 'blockchain.transaction.get_merkle', ['aa', 1], callback
+        message_id = self.network.queue_request(request[0], request[1], self.b)
+        self.network.unanswered_requests[message_id] = request
+        self.b.send_requests()
+        self.network.loop.add_reader(self.b.fileno(), self.network.on_readable, self.b)
+        self.sockets[1].sendall(json.dumps({'id': message_id, 'result': {'pos': 1}}).encode('utf8') + b'\n')
+        with mock.patch.object(self.network, 'wakeup') as wakeup:
+            self.run_loop()
+        callback.assert_called_once_with({'id': message_id, 'result': {'pos': 1},
+                                          'method': request[0], 'params': request[1]})
+        self.assertTrue(wakeup.called)
+
+    def test_set_parameters(self):
+        del self.network.config.cmdline_options['server']
+        self.network.set_parameters('b', '50001', 't', None, False)
+        # applied on the network loop, not by the calling thread
+        self.assertIs(self.a, self.network.interface)
+        with mock.patch.object(self.network, 'send_subscriptions'):
+            self.run_loop()
+        self.assertIs(self.b, self.network.interface)
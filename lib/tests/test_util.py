@@ -1,5 +1,8 @@
+import json
+import socket
+import time
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, LRUCache, SocketPipe, timeout
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +71,99 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache[1] = 'a'
+        cache[2] = 'b'
+        self.assertEqual('a', cache.get(1))
+        cache[3] = 'c'
+        self.assertNotIn(2, cache)
+        self.assertEqual(['a', 'c'], [cache.get(1), cache.get(3)])
+        self.assertEqual(2, len(cache))
+
+    def test_stats(self):
+        cache = LRUCache(10)
+        cache['x'] = 1
+        cache.get('x')
+        cache.get('y')
+        cache.get('x')
+        self.assertEqual({'size': 1, 'hits': 2, 'misses': 1}, cache.stats())
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache[1] = 'a'
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(0, len(cache))
+
+
+class TestSocketPipe(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.pipe = SocketPipe(self.a)
+        self.pipe.set_timeout(0.0)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_get(self):
+        self.b.sendall(b'{"id": 1}\n{"id": 2}\n{"id"')
+        self.assertEqual({'id': 1}, self.pipe.get())
+        self.assertEqual({'id': 2}, self.pipe.get())
+        t0 = time.time()
+        self.assertRaises(timeout, self.pipe.get)
+        # no more data on a non-blocking socket returns at once
+        self.assertLess(time.time() - t0, 0.1)
+        self.b.sendall(b': 3}\n')
+        self.assertEqual({'id': 3}, self.pipe.get())
+
+    def test_get_large(self):
+        messages = [{'id': i, 'result': 'ab' * 100000} for i in range(10)]
+        data = b''.join((json.dumps(m) + '\n').encode('utf8') for m in messages)
+        self.b.setblocking(False)
+        received = []
+        while data or len(received) < len(messages):
+            try:
+                data = data[self.b.send(data[:50000]):]
+            except BlockingIOError:
+                pass
+            try:
+                while True:
+                    received.append(self.pipe.get())
+            except timeout:
+                pass
+            # consumed data does not accumulate
+            self.assertLess(len(self.pipe.buffer), 2 * 200100 + 2 * SocketPipe.read_size)
+        self.assertEqual(messages, received)
+
+    def test_skip_invalid(self):
+        self.b.sendall(b'xyz\n{"id": 1}\n')
+        self.assertEqual({'id': 1}, self.pipe.get())
+
+    def test_closed(self):
+        self.b.close()
+        self.assertIsNone(self.pipe.get())
+
+    def test_send_full_socket(self):
+        messages = [{'id': i, 'params': ['ab' * 100000]} for i in range(20)]
+        t0 = time.time()
+        self.pipe.send_all(messages)
+        # what the socket did not take is kept, without waiting
+        self.assertLess(time.time() - t0, 0.1)
+        self.assertTrue(self.pipe.unsent)
+        self.assertFalse(self.pipe.flush())
+        data = b''
+        while not self.pipe.flush():
+            data += self.b.recv(65536)
+        self.b.setblocking(False)
+        try:
+            while True:
+                data += self.b.recv(65536)
+        except BlockingIOError:
+            pass
+        self.assertEqual(messages, [json.loads(line) for line in data.decode('utf8').splitlines()])
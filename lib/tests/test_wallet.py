@@ -6,7 +6,14 @@ import os
 import json
 
 from io import StringIO
-from lib.storage import WalletStorage, FINAL_SEED_VERSION
+from unittest import mock
+
+from lib import keystore
+from lib import wallet
+from lib.bitcoin import TYPE_ADDRESS, public_key_to_p2pkh
+from lib.util import bfh
+from lib.transaction import Transaction
+from lib.storage import WalletStorage, FINAL_SEED_VERSION, delete_wallet
 
 
 class FakeSynchronizer(object):
@@ -17,6 +24,9 @@ class FakeSynchronizer(object):
     def add(self, address):
         self.store.append(address)
 
+    def add_addresses(self, addresses):
+        self.store.extend(addresses)
+
 
 class WalletTestCase(unittest.TestCase):
 
@@ -67,3 +77,561 @@ class TestWalletStorage(WalletTestCase):
         with open(self.wallet_path, "r") as f:
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
+
+    def test_write_appends_changes_to_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', dict(('label%d' % i, 'x' * 100) for i in range(10)))
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        storage.put('labels', dict(('label%d' % i, 'y' if i == 3 else 'x' * 100) for i in range(10)))
+        storage.put('a', 'b')
+        storage.write()
+        # the wallet file is unchanged, the changed items are in the journal
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(contents, f.read())
+        with open(storage.journal_path(), "r") as f:
+            lines = f.read().splitlines()
+        self.assertEqual([['set', 'labels', 'label3', 'y'], ['put', 'a', 'b']], json.loads(lines[1]))
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual(storage.data, storage2.data)
+
+    def test_journal_is_compacted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write()
+        for i in range(10):
+            storage.put('a', 'x' * 100 * i)
+            storage.write()
+        # the journal grew larger than the wallet file, which was rewritten
+        with open(self.wallet_path, "r") as f:
+            self.assertIn('a', json.loads(f.read()))
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('x' * 900, storage2.get('a'))
+
+    def test_truncated_journal_entry(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'x' * 100)
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        size = os.path.getsize(storage.journal_path())
+        with open(storage.journal_path(), "ab") as f:
+            f.write(b'[["put", "a", "c')
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('b', storage2.get('a'))
+        # and the next entry replaces it
+        storage2.put('a', 'd')
+        storage2.write()
+        storage3 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('d', storage3.get('a'))
+
+    def test_stale_journal_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'x' * 100)
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        # the wallet file is rewritten without knowing of the journal
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({'a': 'c'}))
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual('c', storage2.get('a'))
+        self.assertFalse(os.path.exists(storage.journal_path()))
+
+    def test_encrypted_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'x' * 1000)
+        storage.set_password('secret', True)
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        self.assertTrue(os.path.exists(storage.journal_path()))
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage2.is_encrypted())
+        storage2.decrypt('secret')
+        self.assertEqual('b', storage2.get('a'))
+
+    def test_compact_before_copy(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('labels', dict(('label%d' % i, 'x' * 100) for i in range(10)))
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        self.assertTrue(os.path.exists(storage.journal_path()))
+        # a copy of the wallet file alone lacks the journaled change
+        backup_path = os.path.join(self.user_dir, "backup")
+        shutil.copy2(self.wallet_path, backup_path)
+        self.assertIsNone(WalletStorage(backup_path, manual_upgrades=True).get('a'))
+        storage.compact()
+        self.assertFalse(os.path.exists(storage.journal_path()))
+        shutil.copy2(self.wallet_path, backup_path)
+        self.assertEqual('b', WalletStorage(backup_path, manual_upgrades=True).get('a'))
+        # and later changes go to a new journal
+        storage.put('a', 'c')
+        storage.write()
+        self.assertEqual('c', WalletStorage(self.wallet_path, manual_upgrades=True).get('a'))
+
+    def test_delete_wallet(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('a', 'x' * 100)
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        delete_wallet(self.wallet_path)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertFalse(os.path.exists(storage.journal_path()))
+
+    def test_put_items(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('d', {'a': 1, 'b': 2})
+        storage.write()
+        storage.put_items('d', {'a': (3, 4), 'c': 5}, ['b'])
+        self.assertEqual({'a': [3, 4], 'c': 5}, storage.get('d'))
+        storage.write()
+        storage2 = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual({'a': [3, 4], 'c': 5}, storage2.get('d'))
+
+    def test_get_without_copy(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('d', {'a': 1})
+        self.assertIs(storage.get('d', mutable=False), storage.get('d', mutable=False))
+        self.assertIsNot(storage.get('d'), storage.get('d'))
+
+
+XPUB = 'xpub661MyMwAqRbcGNEPu3aJQqXTydqR9t49Tkwb4Esrj112kw8xLthv8uybxvaki4Ygt9xiwZUQGeFTG7T2TUzR3eA4Zp3aq5RXsABHFBUrq4c'
+
+
+class StandardWalletTestCase(WalletTestCase):
+
+    def create_wallet(self, gap_limit=5):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('keystore', keystore.from_xpub(XPUB).dump())
+        storage.put('gap_limit', gap_limit)
+        w = wallet.Standard_Wallet(storage)
+        w.synchronize()
+        return w
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestAddressIndex(StandardWalletTestCase):
+
+    def check_index(self, w):
+        for is_change, addresses in [(False, w.receiving_addresses), (True, w.change_addresses)]:
+            for i, addr in enumerate(addresses):
+                self.assertTrue(w.is_mine(addr))
+                self.assertEqual(is_change, w.is_change(addr))
+                self.assertEqual((is_change, i), w.get_address_index(addr))
+
+    def test_lookups(self, mock_write):
+        w = self.create_wallet()
+        self.assertEqual(5, len(w.receiving_addresses))
+        self.assertEqual(6, len(w.change_addresses))
+        self.check_index(w)
+        addr = w.create_new_address(True)
+        self.assertEqual((True, 6), w.get_address_index(addr))
+        self.assertFalse(w.is_mine('t1Hsc1LR8yKnbbe3twRp88p6vFfC5t7DLbs'))
+        self.assertFalse(w.is_change('t1Hsc1LR8yKnbbe3twRp88p6vFfC5t7DLbs'))
+        with self.assertRaises(Exception):
+            w.get_address_index('t1Hsc1LR8yKnbbe3twRp88p6vFfC5t7DLbs')
+
+    def test_synchronize_in_batches(self, mock_write):
+        w = self.create_wallet(gap_limit=20)
+        self.assertEqual(20, len(w.receiving_addresses))
+        for i in [0, 7, 19]:
+            self.assertEqual(w.pubkeys_to_address(w.derive_pubkeys(False, i)), w.receiving_addresses[i])
+        self.check_index(w)
+        # an old address at index 10 extends the sequence to 10 + 1 + 20
+        w.storage.put('stored_height', 1000)
+        w.history[w.receiving_addresses[10]] = [('11' * 32, 10)]
+        w.synchronizer = FakeSynchronizer()
+        with mock.patch.object(w, 'save_addresses') as save_addresses:
+            w.synchronize()
+        self.assertEqual(31, len(w.receiving_addresses))
+        self.assertEqual(1, save_addresses.call_count)
+        self.assertEqual(w.receiving_addresses[20:], w.synchronizer.store)
+        self.check_index(w)
+
+    def test_reload(self, mock_write):
+        w = self.create_wallet()
+        w2 = wallet.Standard_Wallet(w.storage)
+        self.check_index(w2)
+
+    def test_change_gap_limit(self, mock_write):
+        w = self.create_wallet(gap_limit=8)
+        dropped = w.receiving_addresses[4:]
+        self.assertTrue(w.change_gap_limit(4))
+        self.assertEqual(4, len(w.receiving_addresses))
+        self.check_index(w)
+        for addr in dropped:
+            self.assertFalse(w.is_mine(addr))
+
+PUBKEY = '0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798'
+
+
+class TransactionsTestCase(StandardWalletTestCase):
+
+    def make_tx(self, w, inputs, outputs):
+        txins = []
+        for addr, prevout_hash, prevout_n in inputs:
+            txin = {'type': 'p2pkh', 'address': addr, 'prevout_hash': prevout_hash,
+                    'prevout_n': prevout_n, 'num_sig': 1, 'signatures': [None]}
+            if w.is_mine(addr):
+                w.add_input_info(txin)
+            else:
+                txin['x_pubkeys'] = txin['pubkeys'] = [PUBKEY]
+            txins.append(txin)
+        outputs = [(TYPE_ADDRESS, addr, v) for addr, v in outputs]
+        # parse it back, as the wallet would see it
+        return Transaction(Transaction.from_io(txins, outputs).serialize())
+
+    def set_history(self, w, addr, hist):
+        w.receive_history_callback(addr, hist, {})
+
+    def setup_wallet(self):
+        w = self.create_wallet()
+        self.a0, self.a1 = w.receiving_addresses[0:2]
+        self.change = w.change_addresses[0]
+        self.outside = public_key_to_p2pkh(bfh(PUBKEY))
+        self.h1 = '11' * 32
+        self.h2 = '22' * 32
+        tx1 = self.make_tx(w, [(self.outside, 'aa' * 32, 0)], [(self.a0, 1000), (self.a1, 2000)])
+        tx2 = self.make_tx(w, [(self.a0, self.h1, 0)], [(self.outside, 600), (self.change, 300)])
+        self.set_history(w, self.a0, [(self.h1, 100)])
+        self.set_history(w, self.a1, [(self.h1, 100)])
+        w.receive_tx_callback(self.h1, tx1, 100)
+        self.tx2 = tx2
+        return w
+
+    def spend(self, w, height):
+        self.set_history(w, self.a0, [(self.h1, 100), (self.h2, height)])
+        self.set_history(w, self.change, [(self.h2, height)])
+        w.receive_tx_callback(self.h2, self.tx2, height)
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestAddrState(TransactionsTestCase):
+
+    def test_balances(self, mock_write):
+        w = self.setup_wallet()
+        self.assertEqual((1000, 0, 0), w.get_addr_balance(self.a0))
+        self.assertEqual((3000, 0, 0), w.get_balance())
+        self.assertEqual(2, len(w.get_utxos()))
+        # spend the first coin, unconfirmed
+        self.spend(w, 0)
+        self.assertEqual((1000, -1000, 0), w.get_addr_balance(self.a0))
+        self.assertEqual((0, 300, 0), w.get_addr_balance(self.change))
+        self.assertEqual((3000, -700, 0), w.get_balance())
+        self.assertEqual([self.h1 + ':1', self.h2 + ':1'],
+                         sorted(x['prevout_hash'] + ':%d' % x['prevout_n'] for x in w.get_utxos()))
+        self.assertEqual(1, len(w.get_utxos(confirmed_only=True)))
+        # the spend confirms
+        self.set_history(w, self.a0, [(self.h1, 100), (self.h2, 101)])
+        self.set_history(w, self.change, [(self.h2, 101)])
+        self.assertEqual((0, 0, 0), w.get_addr_balance(self.a0))
+        self.assertEqual((2300, 0, 0), w.get_balance())
+        # and is reorged away
+        self.set_history(w, self.a0, [(self.h1, 100)])
+        self.set_history(w, self.change, [])
+        self.assertEqual((1000, 0, 0), w.get_addr_balance(self.a0))
+        self.assertEqual((3000, 0, 0), w.get_balance())
+        self.assertEqual(2, len(w.get_utxos()))
+
+    def test_utxos_are_copies(self, mock_write):
+        w = self.setup_wallet()
+        coin = w.get_utxos([self.a0])[0]
+        coin['value'] = 0
+        w.get_addr_utxo(self.a0)[wallet.outpoint_key(self.h1, 0)]['value'] = 0
+        self.assertEqual(1000, w.get_utxos([self.a0])[0]['value'])
+
+    def test_clear_history(self, mock_write):
+        w = self.setup_wallet()
+        self.assertEqual((3000, 0, 0), w.get_balance())
+        w.clear_history()
+        self.assertEqual((0, 0, 0), w.get_balance())
+        self.assertEqual([], w.get_utxos())
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestHistory(TransactionsTestCase):
+
+    def test_history(self, mock_write):
+        w = self.setup_wallet()
+        self.assertEqual([(self.h1, 100, 0, False, 3000, 3000)], w.get_history())
+        self.spend(w, 0)
+        self.assertEqual([(self.h1, 100, 0, False, 3000, 3000),
+                          (self.h2, 0, 0, False, -700, 2300)], w.get_history())
+        self.assertEqual([(self.h1, 100, 0, False, 1000, 1000),
+                          (self.h2, 0, 0, False, -1000, 0)], w.get_history([self.a0]))
+        # the spend confirms
+        self.set_history(w, self.a0, [(self.h1, 100), (self.h2, 101)])
+        self.set_history(w, self.change, [(self.h2, 101)])
+        self.assertEqual([(self.h1, 100, 0, False, 3000, 3000),
+                          (self.h2, 101, 0, False, -700, 2300)], w.get_history())
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 105
+        w.add_verified_tx(self.h1, (100, 1500000000, 1))
+        self.assertEqual((self.h1, 100, 6, 1500000000, 3000, 3000), w.get_history()[0])
+        # confirmations follow the local height
+        w.network.get_local_height.return_value = 106
+        self.assertEqual((self.h1, 100, 7, 1500000000, 3000, 3000), w.get_history()[0])
+
+    def test_paging(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        rows = w.get_history()
+        self.assertEqual(rows[1:], w.get_history(limit=1))
+        self.assertEqual(rows[:1], w.get_history(offset=1, limit=1))
+        self.assertEqual(rows[:1], w.get_history(offset=1))
+        self.assertEqual(rows, w.get_history(limit=5))
+        self.assertEqual([], w.get_history(offset=5, limit=1))
+
+    def test_cached(self, mock_write):
+        w = self.setup_wallet()
+        with mock.patch.object(w, 'get_tx_delta', wraps=w.get_tx_delta) as get_tx_delta:
+            w.get_history()
+            w.get_history()
+            self.assertEqual(2, get_tx_delta.call_count)
+            self.spend(w, 0)
+            w.get_history()
+            self.assertEqual(6, get_tx_delta.call_count)
+
+    def test_moved_in_place(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 105
+        w.get_history()
+        w.get_history([self.a0])
+        with mock.patch.object(w, 'get_tx_delta', wraps=w.get_tx_delta) as get_tx_delta:
+            # confirmed, then verified in a block before the first coin
+            w.add_unverified_tx(self.h2, 101)
+            self.assertEqual([self.h1, self.h2], [row[0] for row in w.get_history()])
+            w.add_verified_tx(self.h2, (99, 1500000000, 1))
+            rows = w.get_history()
+            domain_rows = w.get_history([self.a0])
+            self.assertEqual(0, get_tx_delta.call_count)
+        self.assertEqual([(self.h2, 99, 7, 1500000000, -700, -700),
+                          (self.h1, 100, 0, False, 3000, 2300)], rows)
+        w.invalidate_history()
+        self.assertEqual(rows, w.get_history())
+        self.assertEqual(domain_rows, w.get_history([self.a0]))
+
+    def test_moved_during_rebuild(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 101)
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 105
+        get_balance = w.get_balance
+        def verify_during_rebuild(*args):
+            # the verifier, on the network thread
+            w.add_verified_tx(self.h2, (99, 1500000000, 1))
+            return get_balance(*args)
+        with mock.patch.object(w, 'get_balance', side_effect=verify_during_rebuild):
+            w.get_history()
+        self.assertEqual([self.h2, self.h1], [row[0] for row in w.get_history()])
+        self.assertEqual(-700, w.get_history()[0][5])
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestRemoveTransaction(TransactionsTestCase):
+
+    def check_spenders(self, w):
+        spenders = w.txi_spenders
+        w.build_txi_spenders()
+        self.assertEqual(w.txi_spenders, spenders)
+
+    def test_remove_funding_tx(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        self.assertEqual({self.h1: {self.h2}}, w.txi_spenders)
+        w.remove_transaction(self.h1)
+        self.assertEqual({}, w.txi_spenders)
+        self.assertEqual({}, w.txi[self.h2])
+        self.assertEqual({wallet.outpoint_key(self.h1, 0): self.h2}, w.pruned_txo)
+        # adding it back gives the value to the spending tx
+        w.add_transaction(self.h1, w.transactions[self.h1])
+        self.assertEqual({self.a0: [(wallet.outpoint_key(self.h1, 0), 1000)]}, w.txi[self.h2])
+        self.assertEqual({}, w.pruned_txo)
+        self.check_spenders(w)
+
+    def test_remove_spending_tx(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.remove_transaction(self.h2)
+        self.assertEqual({}, w.txi_spenders)
+        self.assertNotIn(self.h2, w.txi)
+        self.assertEqual((1000, 0, 0), w.get_addr_balance(self.a0))
+        self.check_spenders(w)
+
+    def test_spenders_are_loaded(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.save_transactions()
+        w2 = wallet.Standard_Wallet(w.storage)
+        self.assertEqual({self.h1: {self.h2}}, w2.txi_spenders)
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestOutpoints(TransactionsTestCase):
+
+    def test_outpoint_key(self, mock_write):
+        key = wallet.outpoint_key('11' * 32, 3)
+        self.assertEqual(36, len(key))
+        self.assertEqual('11' * 32, wallet.outpoint_hash(key))
+        self.assertEqual(3, wallet.outpoint_n(key))
+        self.assertEqual(key, wallet.outpoint_from_str('11' * 32 + ':3'))
+        self.assertEqual('11' * 32 + ':3', wallet.outpoint_to_str(key))
+
+    def test_storage_format(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.save_transactions()
+        self.assertEqual([[self.h1 + ':0', 1000]], w.storage.get('txi')[self.h2][self.a0])
+        w.remove_transaction(self.h1)
+        w.save_transactions()
+        self.assertEqual({self.h1 + ':0': self.h2}, w.storage.get('pruned_txo'))
+        w2 = wallet.Standard_Wallet(w.storage)
+        self.assertEqual(w.txi, w2.txi)
+        self.assertEqual(w.pruned_txo, w2.pruned_txo)
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestSaveTransactions(TransactionsTestCase):
+
+    def check_saved(self, w):
+        w.save_transactions()
+        w2 = wallet.Standard_Wallet(w.storage)
+        self.assertEqual(w.txi, w2.txi)
+        # tuples are read back as lists
+        self.assertEqual(json.loads(json.dumps(w.txo)), w2.txo)
+        self.assertEqual(w.pruned_txo, w2.pruned_txo)
+        self.assertEqual(w.tx_fees, w2.tx_fees)
+        # unreferenced transactions are dropped when loading
+        self.assertTrue(set(w.txi) <= set(w2.transactions) <= set(w.transactions))
+        self.assertEqual(json.loads(json.dumps(w.history)), w2.history)
+        self.assertEqual(w.get_balance(), w2.get_balance())
+
+    def test_save_changes(self, mock_write):
+        w = self.setup_wallet()
+        self.check_saved(w)
+        self.spend(w, 0)
+        self.check_saved(w)
+        w.remove_transaction(self.h1)
+        self.check_saved(w)
+        w.clear_history()
+        self.check_saved(w)
+
+    def test_only_changes_are_saved(self, mock_write):
+        w = self.setup_wallet()
+        w.save_transactions()
+        w.storage.pending = []
+        self.set_history(w, self.a1, [(self.h1, 101)])
+        w.save_transactions()
+        self.assertEqual([['set', 'addr_history', self.a1, [[self.h1, 101]]],
+                          ['set', 'tx_addr_hist', self.h1, sorted([self.a0, self.a1])],
+                          ['set', 'checked_history', self.a1, wallet.history_fingerprint([(self.h1, 101)])]],
+                         [json.loads(op) for op in w.storage.pending])
+
+
+class TestTxStore(unittest.TestCase):
+
+    RAW = ['01000000' + '%02x' % i * 10 for i in range(3)]
+
+    def test_lookups(self):
+        store = wallet.TxStore(cache_size=2)
+        for i, raw in enumerate(self.RAW):
+            store.load('%d' % i, raw)
+        self.assertEqual(0, len(store.cache))
+        self.assertEqual(3, len(store))
+        self.assertEqual(['0', '1', '2'], sorted(store))
+        self.assertIn('1', store)
+        tx = store['1']
+        self.assertEqual(self.RAW[1], str(tx))
+        self.assertIs(tx, store.get('1'))
+        self.assertIsNone(store.get('3'))
+        # only the most recently used transactions are kept
+        store['0'], store['2']
+        self.assertIsNot(tx, store['1'])
+        self.assertEqual(2, len(store.cache))
+
+    def test_set_and_delete(self):
+        store = wallet.TxStore()
+        tx = Transaction(self.RAW[0])
+        store['a'] = tx
+        self.assertIs(tx, store['a'])
+        self.assertEqual(self.RAW[0], store.pop('a').raw)
+        self.assertNotIn('a', store)
+        self.assertEqual(0, len(store.cache))
+        with self.assertRaises(KeyError):
+            store['a']
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestLazyTransactions(TransactionsTestCase):
+
+    def test_not_parsed_when_loading(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.save_transactions()
+        w2 = wallet.Standard_Wallet(w.storage)
+        self.assertEqual({self.h1, self.h2}, set(w2.transactions))
+        self.assertEqual(0, len(w2.transactions.cache))
+        self.assertEqual(str(w.transactions[self.h2]), str(w2.transactions[self.h2]))
+
+
+@mock.patch.object(WalletStorage, '_write')
+class TestCheckedHistory(TransactionsTestCase):
+
+    def reopen(self, storage):
+        with mock.patch.object(wallet.Abstract_Wallet, 'check_history') as check_history:
+            w = wallet.Standard_Wallet(storage)
+        check_history.assert_called_once_with(mock.ANY)
+        return w, check_history.call_args[0][0]
+
+    def check_reverse_history(self, w):
+        tx_addr_hist = w.tx_addr_hist
+        w.build_reverse_history()
+        self.assertEqual(w.tx_addr_hist, tx_addr_hist)
+
+    def test_unchanged(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.save_transactions()
+        self.assertEqual(wallet.CHECKED_HISTORY_VERSION, w.storage.get('checked_history_version'))
+        w2, stale = self.reopen(w.storage)
+        self.assertEqual([], stale)
+        self.check_reverse_history(w2)
+
+    def test_history_changed_elsewhere(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 0)
+        w.save_transactions()
+        history = w.storage.get('addr_history')
+        history[self.a0] = [[self.h2, 0]]
+        history[self.a1].append([self.h2, 0])
+        w.storage.put('addr_history', history)
+        w2, stale = self.reopen(w.storage)
+        self.assertEqual({self.a0, self.a1}, set(stale))
+        self.check_reverse_history(w2)
+
+    def test_height_changed_elsewhere(self, mock_write):
+        w = self.setup_wallet()
+        self.spend(w, 101)
+        w.save_transactions()
+        # same length and last tx, as after a reorg
+        history = w.storage.get('addr_history')
+        history[self.a0] = [[self.h1, 99], [self.h2, 101]]
+        w.storage.put('addr_history', history)
+        w2, stale = self.reopen(w.storage)
+        self.assertEqual([self.a0], list(stale))
+
+    def test_not_saved_yet(self, mock_write):
+        w = self.setup_wallet()
+        w.save_transactions()
+        w.storage.put('checked_history_version', None)
+        w2, stale = self.reopen(w.storage)
+        self.assertIsNone(stale)
+        self.check_reverse_history(w2)
+        w2.save_transactions()
+        w3, stale = self.reopen(w2.storage)
+        self.assertEqual([], stale)
@@ -22,7 +22,7 @@
 # SOFTWARE.
 import binascii
 import os, sys, re, json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -226,6 +226,57 @@ def profiler(func):
     return lambda *args, **kw_args: do_profile(func, args, kw_args)
 
 
+class LRUCache(object):
+    '''A mapping of at most size entries that drops the least recently
+    used one when full.  Lookups are counted in hits and misses, to
+    help choosing the size.  Not thread safe.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def items(self):
+        return list(self.data.items())
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+
 def android_ext_dir():
     import jnius
     env = jnius.autoclass('android.os.Environment')
@@ -588,9 +639,25 @@ import time
 
 
 class SocketPipe:
+    '''Reads newline separated JSON messages from a socket.
+
+    Received data is appended to a bytearray, and messages are parsed
+    from self.offset onwards without copying the rest of the buffer.
+    The consumed part of the buffer is discarded once it is large
+    enough, so that a big response read in many pieces, or many
+    responses read at once, cost linear time.'''
+
+    read_size = 65536
+
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        self.buffer = bytearray()
+        # start of the first message not returned yet
+        self.offset = 0
+        # there is no newline in buffer[offset:scanned]
+        self.scanned = 0
+        # data sent but not written to the socket yet, see flush()
+        self.unsent = bytearray()
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -600,23 +667,52 @@ class SocketPipe:
     def idle_time(self):
         return time.time() - self.recv_time
 
+    def next_message(self):
+        '''Returns the next complete line in the buffer as a
+        memoryview, or None.'''
+        n = self.buffer.find(b'\n', self.scanned)
+        if n == -1:
+            self.scanned = len(self.buffer)
+            return None
+        line = memoryview(self.buffer)[self.offset:n]
+        self.offset = self.scanned = n + 1
+        return line
+
+    def compact(self):
+        if self.offset == len(self.buffer):
+            del self.buffer[:]
+        elif self.offset < self.read_size or 2 * self.offset < len(self.buffer):
+            return
+        else:
+            del self.buffer[:self.offset]
+        self.scanned -= self.offset
+        self.offset = 0
+
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            line = self.next_message()
+            while line is not None:
+                try:
+                    with line:
+                        return json.loads(str(line, 'utf8'))
+                except:
+                    line = self.next_message()
+            self.compact()
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(self.read_size)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
                 raise timeout
+            except BlockingIOError:
+                # non-blocking socket with no more data; the caller
+                # waits for it to become readable again
+                raise timeout
             except socket.error as err:
                 if err.errno == 60:
                     raise timeout
                 elif err.errno in [11, 35, 10035]:
                     print_error("socket errno %d (resource temporarily unavailable)"% err.errno)
-                    time.sleep(0.2)
                     raise timeout
                 else:
                     print_error("pipe: socket error", err)
@@ -627,7 +723,7 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += data
             self.recv_time = time.time()
 
     def send(self, request):
@@ -640,18 +736,26 @@ class SocketPipe:
         self._send(out)
 
     def _send(self, out):
-        while out:
+        self.unsent += out
+        self.flush()
+
+    def flush(self):
+        '''Writes as much of the unsent data as the socket takes.
+        Returns whether all of it was written; if not, the caller
+        waits for the socket to become writable and flushes again.'''
+        while self.unsent:
             try:
-                sent = self.socket.send(out)
-                out = out[sent:]
+                sent = self.socket.send(self.unsent)
+            except (BlockingIOError, socket.timeout, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                return False
             except ssl.SSLError as e:
                 print_error("SSLError:", e)
-                time.sleep(0.1)
-                continue
+                return False
             except OSError as e:
                 print_error("OSError", e)
-                time.sleep(0.1)
-                continue
+                return False
+            del self.unsent[:sent]
+        return True
 
 
 class QueuePipe:
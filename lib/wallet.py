@@ -28,6 +28,8 @@
 
 
 import os
+import hashlib
+import bisect
 import threading
 import random
 import time
@@ -37,12 +39,13 @@ import errno
 import traceback
 from functools import partial
 from collections import defaultdict
+from collections.abc import MutableMapping
 from numbers import Number
 
 import sys
 
 from .i18n import _
-from .util import (NotEnoughFunds, PrintError, UserCancelled, profiler,
+from .util import (NotEnoughFunds, PrintError, UserCancelled, profiler, LRUCache,
                    format_satoshis, NoDynamicFeeEstimates)
 
 from .bitcoin import *
@@ -72,6 +75,69 @@ TX_STATUS = [
 ]
 
 
+# Outpoints are kept in memory as 36 byte keys: the tx hash followed by
+# the output index.  Storage uses "tx_hash:n" strings.
+def outpoint_key(prevout_hash, prevout_n):
+    return bfh(prevout_hash) + prevout_n.to_bytes(4, 'little')
+
+def outpoint_hash(key):
+    return bh2u(key[:32])
+
+def outpoint_n(key):
+    return int.from_bytes(key[32:], 'little')
+
+def outpoint_from_str(ser):
+    prevout_hash, prevout_n = ser.split(':')
+    return outpoint_key(prevout_hash, int(prevout_n))
+
+def outpoint_to_str(key):
+    return outpoint_hash(key) + ':%d'%outpoint_n(key)
+
+
+class TxStore(MutableMapping):
+    '''The transactions of a wallet, by hash.  They are kept as raw
+    bytes, and a Transaction is only built when one is looked up.  The
+    most recently used Transaction objects are kept, so that they are
+    not deserialized again.'''
+
+    def __init__(self, cache_size=1000):
+        self.lock = threading.Lock()
+        self.raw = {}
+        self.cache = LRUCache(cache_size)
+
+    def load(self, tx_hash, raw):
+        # raw hex, as found in storage
+        with self.lock:
+            self.raw[tx_hash] = bfh(raw)
+
+    def __getitem__(self, tx_hash):
+        with self.lock:
+            tx = self.cache.get(tx_hash)
+            if tx is None:
+                tx = Transaction(bh2u(self.raw[tx_hash]))
+                self.cache[tx_hash] = tx
+            return tx
+
+    def __setitem__(self, tx_hash, tx):
+        raw = bfh(str(tx))
+        with self.lock:
+            self.raw[tx_hash] = raw
+            self.cache[tx_hash] = tx
+
+    def __delitem__(self, tx_hash):
+        with self.lock:
+            del self.raw[tx_hash]
+            self.cache.pop(tx_hash)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raw
+
+    def __iter__(self):
+        return iter(list(self.raw))
+
+    def __len__(self):
+        return len(self.raw)
+
 
 def relayfee(network):
     RELAY_FEE = 1000
@@ -153,6 +219,21 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100):
     return tx
 
 
+# version of the tx_addr_hist and checked_history entries in storage
+CHECKED_HISTORY_VERSION = 2
+
+def history_fingerprint(hist):
+    # tells whether the history of an address changed since it was
+    # checked: the status hash servers send for it, which covers every
+    # tx hash and height
+    if not hist:
+        return None
+    if hist == ['*']:
+        return '*'
+    status = ''.join('%s:%d:' % (tx_hash, height) for tx_hash, height in hist)
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -160,6 +241,7 @@ class Abstract_Wallet(PrintError):
     """
 
     max_change_outputs = 3
+    max_cached_transactions = 1000
 
     def __init__(self, storage):
         self.electrum_version = ELECTRUM_VERSION
@@ -176,11 +258,13 @@ class Abstract_Wallet(PrintError):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        # storage key -> entries changed since the last save_transactions
+        self.dirty = defaultdict(set)
 
         self.load_keystore()
         self.load_addresses()
         self.load_transactions()
-        self.build_reverse_history()
+        stale = self.load_reverse_history()
 
         # load requests
         self.receive_requests = self.storage.get('payment_requests', {})
@@ -198,8 +282,17 @@ class Abstract_Wallet(PrintError):
         self.up_to_date = False
         self.lock = threading.Lock()
         self.transaction_lock = threading.Lock()
-
-        self.check_history()
+        # address -> unspent coins and balance, see get_addr_state
+        self._addr_state = {}
+        # domain -> (version, sorted history rows, their txpos), see
+        # get_history_rows
+        self._history_cache = LRUCache(8)
+        self._history_version = 0
+        # counts move_history_row calls, which a rebuild may have missed
+        self._history_moves = 0
+        self._history_lock = threading.Lock()
+
+        self.check_history(stale)
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -221,44 +314,90 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
+        self.txi = {}
+        for tx_hash, d in self.storage.get('txi', {}, mutable=False).items():
+            self.txi[tx_hash] = dict((addr, [(outpoint_from_str(ser), v) for ser, v in l])
+                                     for addr, l in d.items())
         self.txo = self.storage.get('txo', {})
         self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
+        self.pruned_txo = dict((outpoint_from_str(ser), tx_hash)
+                               for ser, tx_hash in self.storage.get('pruned_txo', {}, mutable=False).items())
+        self.build_txi_spenders()
+        tx_list = self.storage.get('transactions', {}, mutable=False)
+        self.transactions = TxStore(self.max_cached_transactions)
+        pruned_spenders = set(self.pruned_txo.values())
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and tx_hash not in pruned_spenders:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self.dirty['transactions'].add(tx_hash)
+            else:
+                self.transactions.load(tx_hash, raw)
 
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
+            dirty, self.dirty = self.dirty, defaultdict(set)
+            self.save_items(dirty, 'transactions', self.transactions, value=str)
+            self.save_items(dirty, 'txi', self.txi,
+                            value=lambda d: dict((addr, [(outpoint_to_str(key), v) for key, v in l])
+                                                 for addr, l in d.items()))
+            self.save_items(dirty, 'txo', self.txo)
+            self.save_items(dirty, 'tx_fees', self.tx_fees)
+            self.save_items(dirty, 'pruned_txo', self.pruned_txo, key=outpoint_to_str)
+            self.save_items(dirty, 'addr_history', self.history)
+            self.save_items(dirty, 'tx_addr_hist', self.tx_addr_hist, value=sorted)
+            dirty['checked_history'] |= dirty['addr_history']
+            self.save_items(dirty, 'checked_history', self.history, value=history_fingerprint)
             if write:
                 self.storage.write()
 
+    def save_items(self, dirty, name, d, key=None, value=None):
+        # write the entries of d marked in dirty[name] to storage
+        items = {}
+        removed = []
+        for k in dirty.get(name, ()):
+            storage_key = key(k) if key else k
+            if k in d:
+                items[storage_key] = value(d[k]) if value else d[k]
+            else:
+                removed.append(storage_key)
+        self.storage.put_items(name, items, removed)
+
     def clear_history(self):
         with self.transaction_lock:
             self.txi = {}
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
-        self.save_transactions()
+            self.txi_spenders = defaultdict(set)
+            self._addr_state = {}
+            self.dirty = defaultdict(set)
+            for name in ['txi', 'txo', 'tx_fees', 'pruned_txo', 'addr_history',
+                         'tx_addr_hist', 'checked_history']:
+                self.storage.put(name, {})
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+        self.invalidate_history()
+
+    def build_txi_spenders(self):
+        # prevout hash -> txs with a txi entry spending one of its outputs
+        self.txi_spenders = defaultdict(set)
+        for next_tx, dd in self.txi.items():
+            for l in dd.values():
+                for key, v in l:
+                    self.txi_spenders[outpoint_hash(key)].add(next_tx)
+
+    def remove_txi_spenders(self, tx_hash):
+        # call with self.transaction_lock held
+        for l in self.txi.get(tx_hash, {}).values():
+            for key, v in l:
+                prev_hash = outpoint_hash(key)
+                spenders = self.txi_spenders.get(prev_hash)
+                if spenders is not None:
+                    spenders.discard(tx_hash)
+                    if not spenders:
+                        self.txi_spenders.pop(prev_hash)
 
     @profiler
     def build_reverse_history(self):
@@ -270,16 +409,57 @@ class Abstract_Wallet(PrintError):
                 self.tx_addr_hist[tx_hash] = s
 
     @profiler
-    def check_history(self):
+    def load_reverse_history(self):
+        '''Loads tx_addr_hist as saved with the history, and updates it
+        for the addresses whose history changed since, e.g. because the
+        wallet was saved by another version.  Returns those addresses,
+        which check_history has to look at, or None if tx_addr_hist was
+        rebuilt from scratch.'''
+        checked = self.storage.get('checked_history', {}, mutable=False)
+        if self.storage.get('checked_history_version') != CHECKED_HISTORY_VERSION:
+            self.build_reverse_history()
+            self.dirty['tx_addr_hist'].update(self.tx_addr_hist)
+            self.dirty['checked_history'].update(self.history)
+            self.dirty['checked_history'].update(checked)
+            self.storage.put('checked_history_version', CHECKED_HISTORY_VERSION)
+            return None
+        stored = self.storage.get('tx_addr_hist', {}, mutable=False)
+        self.tx_addr_hist = dict((tx_hash, set(addrs)) for tx_hash, addrs in stored.items())
+        stale = set(addr for addr, hist in self.history.items()
+                    if checked.get(addr) != history_fingerprint(hist))
+        stale.update(addr for addr in checked if addr not in self.history)
+        if not stale:
+            return []
+        self.print_error("history changed for %d addresses" % len(stale))
+        for tx_hash, addrs in list(self.tx_addr_hist.items()):
+            if not addrs.isdisjoint(stale):
+                addrs -= stale
+                self.dirty['tx_addr_hist'].add(tx_hash)
+                if not addrs:
+                    self.tx_addr_hist.pop(tx_hash)
+        for addr in stale:
+            for tx_hash, height in self.history.get(addr, []):
+                self.tx_addr_hist.setdefault(tx_hash, set()).add(addr)
+                self.dirty['tx_addr_hist'].add(tx_hash)
+        self.dirty['checked_history'].update(stale)
+        return list(stale)
+
+    @profiler
+    def check_history(self, addresses=None):
+        '''Adds the transactions of addresses, all by default, that are
+        in their history but missing from txi and txo.'''
         save = False
-        mine_addrs = list(filter(lambda k: self.is_mine(self.history[k]), self.history.keys()))
+        mine_addrs = list(filter(lambda k: self.is_mine(k), self.history.keys()))
         if len(mine_addrs) != len(self.history.keys()):
             save = True
+        if addresses is not None:
+            mine_addrs = [addr for addr in addresses if self.is_mine(addr) and addr in self.history]
+        pruned_spenders = set(self.pruned_txo.values())
         for addr in mine_addrs:
             hist = self.history[addr]
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in pruned_spenders or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -299,6 +479,15 @@ class Abstract_Wallet(PrintError):
         if type(d) != dict: d={}
         self.receiving_addresses = d.get('receiving', [])
         self.change_addresses = d.get('change', [])
+        self.build_address_index()
+
+    def build_address_index(self):
+        # address -> (is_change, index)
+        self._addr_to_addr_index = {}
+        for i, addr in enumerate(self.receiving_addresses):
+            self._addr_to_addr_index[addr] = (False, i)
+        for i, addr in enumerate(self.change_addresses):
+            self._addr_to_addr_index[addr] = (True, i)
 
     def synchronize(self):
         pass
@@ -332,19 +521,17 @@ class Abstract_Wallet(PrintError):
         return changed
 
     def is_mine(self, address):
-        return address in self.get_addresses()
+        return address in self._addr_to_addr_index
 
     def is_change(self, address):
-        if not self.is_mine(address):
-            return False
-        return address in self.change_addresses
+        index = self._addr_to_addr_index.get(address)
+        return index is not None and index[0]
 
     def get_address_index(self, address):
-        if address in self.receiving_addresses:
-            return False, self.receiving_addresses.index(address)
-        if address in self.change_addresses:
-            return True, self.change_addresses.index(address)
-        raise Exception("Address not found", address)
+        index = self._addr_to_addr_index.get(address)
+        if index is None:
+            raise Exception("Address not found", address)
+        return index
 
     def export_private_key(self, address, password):
         """ extended WIF format """
@@ -371,13 +558,17 @@ class Abstract_Wallet(PrintError):
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
+            moved = self.unverified_tx.get(tx_hash) != tx_height
             self.unverified_tx[tx_hash] = tx_height
+            if moved:
+                self.move_history_row(tx_hash)
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+        self.move_history_row(tx_hash)
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -397,6 +588,8 @@ class Abstract_Wallet(PrintError):
                     if not header or header.get('timestamp') != timestamp:
                         self.verified_tx.pop(tx_hash, None)
                         txs.add(tx_hash)
+        if txs:
+            self.invalidate_history()
         return txs
 
     def get_local_height(self):
@@ -452,7 +645,6 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.get_addresses()
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -460,7 +652,7 @@ class Abstract_Wallet(PrintError):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
             addr = item.get('address')
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -480,7 +672,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -556,31 +748,63 @@ class Abstract_Wallet(PrintError):
         for tx_hash, height in h:
             l = self.txo.get(tx_hash, {}).get(address, [])
             for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
+                received[outpoint_key(tx_hash, n)] = (height, v, is_cb)
         for tx_hash, height in h:
             l = self.txi.get(tx_hash, {}).get(address, [])
             for txi, v in l:
                 sent[txi] = height
         return received, sent
 
+    def get_addr_state(self, address):
+        '''Returns (coins, c, u, coinbase) for address, where coins maps
+        the unspent outpoints to coin records, c and u are the confirmed
+        and unconfirmed balances without the coinbase outputs, and
+        coinbase lists the (height, value) of those.  Whether a coinbase
+        output has matured depends on the local height, so it is decided
+        by get_addr_balance.  The state is cached until the history of
+        the address or a transaction touching it changes.'''
+        with self.transaction_lock:
+            state = self._addr_state.get(address)
+            if state is not None:
+                return state
+            received, sent = self.get_addr_io(address)
+            coins = {}
+            c = u = 0
+            coinbase = []
+            for txo, (tx_height, v, is_cb) in received.items():
+                if is_cb:
+                    coinbase.append((tx_height, v))
+                elif tx_height > 0:
+                    c += v
+                else:
+                    u += v
+                if txo in sent:
+                    if sent[txo] > 0:
+                        c -= v
+                    else:
+                        u -= v
+                    continue
+                coins[txo] = {
+                    'address':address,
+                    'value':v,
+                    'prevout_n':outpoint_n(txo),
+                    'prevout_hash':outpoint_hash(txo),
+                    'height':tx_height,
+                    'coinbase':is_cb
+                }
+            state = coins, c, u, coinbase
+            self._addr_state[address] = state
+            return state
+
+    def invalidate_addr_state(self, addresses):
+        # call with self.transaction_lock held
+        for addr in addresses:
+            self._addr_state.pop(addr, None)
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
-        return out
+        coins = self.get_addr_state(address)[0]
+        # coin records end up in transactions, they must not share the cache
+        return dict((txo, dict(x)) for txo, x in coins.items())
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
@@ -589,20 +813,17 @@ class Abstract_Wallet(PrintError):
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
+        coins, c, u, coinbase = self.get_addr_state(address)
+        x = 0
+        if coinbase:
+            local_height = self.get_local_height()
+            for tx_height, v in coinbase:
+                if tx_height + COINBASE_MATURITY > local_height:
+                    x += v
+                elif tx_height > 0:
+                    c += v
                 else:
-                    u -= v
+                    u += v
         return c, u, x
 
     def get_spendable_coins(self, domain, config):
@@ -615,15 +836,14 @@ class Abstract_Wallet(PrintError):
             domain = self.get_addresses()
         if exclude_frozen:
             domain = set(domain) - self.frozen_addresses
+        local_height = self.get_local_height()
         for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
+            for x in self.get_addr_state(addr)[0].values():
                 if confirmed_only and x['height'] <= 0:
                     continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
+                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
                     continue
-                coins.append(x)
-                continue
+                coins.append(dict(x))
         return coins
 
     def dummy_address(self):
@@ -666,6 +886,11 @@ class Abstract_Wallet(PrintError):
 
         is_coinbase = not is_shielded_input and tx.inputs()[0]['type'] == 'coinbase'
         with self.transaction_lock:
+            self.invalidate_addr_state(self.txi.get(tx_hash, {}))
+            self.invalidate_addr_state(self.txo.get(tx_hash, {}))
+            self.remove_txi_spenders(tx_hash)
+            for name in ['transactions', 'txi', 'txo']:
+                self.dirty[name].add(tx_hash)
             # add inputs
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
@@ -673,7 +898,7 @@ class Abstract_Wallet(PrintError):
                 if txi['type'] != 'coinbase':
                     prevout_hash = txi['prevout_hash']
                     prevout_n = txi['prevout_n']
-                    ser = prevout_hash + ':%d'%prevout_n
+                    ser = outpoint_key(prevout_hash, prevout_n)
                 if addr == "(pubkey)":
                     addr = self.find_pay_to_pubkey_address(prevout_hash, prevout_n)
                 # find value from prev output
@@ -684,14 +909,17 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self.txi_spenders[prevout_hash].add(tx_hash)
                             break
                     else:
                         self.pruned_txo[ser] = tx_hash
+                        self.dirty['pruned_txo'].add(ser)
+            self.invalidate_addr_state(d)
 
             # add outputs
             self.txo[tx_hash] = d = {}
             for n, txo in enumerate(tx.outputs()):
-                ser = tx_hash + ':%d'%n
+                ser = outpoint_key(tx_hash, n)
                 _type, x, v = txo
                 if _type == TYPE_ADDRESS:
                     addr = x
@@ -707,39 +935,67 @@ class Abstract_Wallet(PrintError):
                 next_tx = self.pruned_txo.get(ser)
                 if next_tx is not None:
                     self.pruned_txo.pop(ser)
+                    self.dirty['pruned_txo'].add(ser)
+                    self.dirty['txi'].add(next_tx)
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.txi_spenders[tx_hash].add(next_tx)
+                    self.invalidate_addr_state([addr])
+            self.invalidate_addr_state(d)
             # save
             self.transactions[tx_hash] = tx
+        self.invalidate_history()
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in list(self.pruned_txo.items()):
-                if hh == tx_hash:
-                    self.pruned_txo.pop(ser)
+            # pruned_txo maps inputs of the spending tx to it
+            tx = self.transactions.get(tx_hash)
+            if tx is not None:
+                for txin in tx.inputs():
+                    if txin['type'] == 'coinbase':
+                        continue
+                    ser = outpoint_key(txin['prevout_hash'], txin['prevout_n'])
+                    if self.pruned_txo.get(ser) == tx_hash:
+                        self.pruned_txo.pop(ser)
+                        self.dirty['pruned_txo'].add(ser)
+            else:
+                for ser, hh in list(self.pruned_txo.items()):
+                    if hh == tx_hash:
+                        self.pruned_txo.pop(ser)
+                        self.dirty['pruned_txo'].add(ser)
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            prefix = bfh(tx_hash)
+            for next_tx in self.txi_spenders.pop(tx_hash, ()):
+                dd = self.txi.get(next_tx, {})
                 for addr, l in list(dd.items()):
                     ll = l[:]
                     for item in ll:
                         ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
+                        if ser[:32] == prefix:
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
+                            self.dirty['pruned_txo'].add(ser)
+                            self.dirty['txi'].add(next_tx)
+                            self.invalidate_addr_state([addr])
                     if l == []:
                         dd.pop(addr)
                     else:
                         dd[addr] = l
+            self.invalidate_addr_state(self.txi.get(tx_hash, {}))
+            self.invalidate_addr_state(self.txo.get(tx_hash, {}))
+            self.remove_txi_spenders(tx_hash)
+            self.dirty['txi'].add(tx_hash)
+            self.dirty['txo'].add(tx_hash)
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+        self.invalidate_history()
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
@@ -751,30 +1007,107 @@ class Abstract_Wallet(PrintError):
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # remove tx if it's not referenced in histories
-                    self.tx_addr_hist[tx_hash].remove(addr)
-                    if not self.tx_addr_hist[tx_hash]:
+                    s = self.tx_addr_hist.get(tx_hash, set())
+                    s.discard(addr)
+                    self.dirty['tx_addr_hist'].add(tx_hash)
+                    if not s:
+                        self.tx_addr_hist.pop(tx_hash, None)
                         self.remove_transaction(tx_hash)
-            self.history[addr] = hist
+            with self.transaction_lock:
+                self.history[addr] = hist
+                self.dirty['addr_history'].add(addr)
+                # add references in tx_addr_hist
+                for tx_hash, tx_height in hist:
+                    s = self.tx_addr_hist.setdefault(tx_hash, set())
+                    if addr not in s:
+                        s.add(addr)
+                        self.dirty['tx_addr_hist'].add(tx_hash)
+                self.invalidate_addr_state([addr])
+            self.invalidate_history()
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
             self.add_unverified_tx(tx_hash, tx_height)
-            # add reference in tx_addr_hist
-            s = self.tx_addr_hist.get(tx_hash, set())
-            s.add(addr)
-            self.tx_addr_hist[tx_hash] = s
             # if addr is new, we have to recompute txi and txo
             tx = self.transactions.get(tx_hash)
             if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
                 self.add_transaction(tx_hash, tx)
 
         # Store fees
-        self.tx_fees.update(tx_fees)
+        with self.transaction_lock:
+            self.tx_fees.update(tx_fees)
+            self.dirty['tx_fees'].update(tx_fees)
+
+    def invalidate_history(self):
+        with self._history_lock:
+            self._history_version += 1
+
+    def move_history_row(self, tx_hash):
+        '''Called when the height or position in its block of tx_hash
+        changed.  Its delta is the same, so its cached rows are moved to
+        the new place, and only the balances in between are updated.'''
+        pos = self.get_txpos(tx_hash)
+        with self._history_lock:
+            self._history_moves += 1
+            for key, (version, rows, positions) in self._history_cache.items():
+                if version != self._history_version:
+                    continue
+                i = next((i for i, row in enumerate(rows) if row[0] == tx_hash), None)
+                if i is None:
+                    continue
+                row = rows[i]
+                rows = rows[:i] + rows[i+1:]
+                positions = positions[:i] + positions[i+1:]
+                j = bisect.bisect_right(positions, pos)
+                rows.insert(j, row)
+                positions.insert(j, pos)
+                start = min(i, j)
+                balance = rows[start - 1][2] if start else 0
+                for k in range(start, max(i, j) + 1):
+                    tx, delta, _ = rows[k]
+                    if balance is None or delta is None:
+                        balance = None
+                        break
+                    balance += delta
+                    rows[k] = (tx, delta, balance)
+                if balance is None:
+                    # cannot be updated from below, rebuild it
+                    self._history_cache.pop(key)
+                else:
+                    self._history_cache[key] = (version, rows, positions)
+
+    def get_history(self, domain=None, offset=0, limit=None):
+        '''Returns the history of domain, oldest first, as (tx_hash,
+        height, conf, timestamp, delta, balance) rows.  offset and limit
+        select a page counted from the most recent transaction, so that
+        offset=0, limit=100 returns the last 100 rows.'''
+        rows = self.get_history_rows(domain)
+        end = len(rows) - offset
+        start = 0 if limit is None else max(end - limit, 0)
+        h2 = []
+        for tx_hash, delta, balance in rows[start:max(end, 0)]:
+            height, conf, timestamp = self.get_tx_height(tx_hash)
+            h2.append((tx_hash, height, conf, timestamp, delta, balance))
+        return h2
 
-    def get_history(self, domain=None):
+    def get_history_rows(self, domain=None):
+        '''Returns the sorted (tx_hash, delta, balance) rows of domain.
+        They are rebuilt after a history change or a new transaction, and
+        moved in place by move_history_row when a transaction is verified
+        or its height changes.  Confirmations change with every block and
+        are looked up by get_history.'''
         # get domain
         if domain is None:
+            key = None
             domain = self.get_addresses()
+        else:
+            key = frozenset(domain)
+        with self._history_lock:
+            version = self._history_version
+            moves = self._history_moves
+            cached = self._history_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -788,31 +1121,36 @@ class Abstract_Wallet(PrintError):
                     tx_deltas[tx_hash] += delta
 
         # 2. create sorted history
-        history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            height, conf, timestamp = self.get_tx_height(tx_hash)
-            history.append((tx_hash, height, conf, timestamp, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]))
+        history = [(tx_hash, delta, self.get_txpos(tx_hash)) for tx_hash, delta in tx_deltas.items()]
+        history.sort(key = lambda x: x[2])
         history.reverse()
 
         # 3. add balance
         c, u, x = self.get_balance(domain)
         balance = c + u + x
         h2 = []
-        for tx_hash, height, conf, timestamp, delta in history:
-            h2.append((tx_hash, height, conf, timestamp, delta, balance))
+        positions = []
+        for tx_hash, delta, pos in history:
+            h2.append((tx_hash, delta, balance))
+            positions.append(pos)
             if balance is None or delta is None:
                 balance = None
             else:
                 balance -= delta
         h2.reverse()
+        positions.reverse()
 
         # fixme: this may happen if history is incomplete
         if balance not in [None, 0]:
             self.print_error("Error: history not synchronized")
-            return []
-
+            h2 = []
+            positions = []
+
+        with self._history_lock:
+            # rows built while the history changed or a transaction
+            # moved may be stale already
+            if version == self._history_version and moves == self._history_moves:
+                self._history_cache[key] = (version, h2, positions)
         return h2
 
     def get_label(self, tx_hash):
@@ -975,6 +1313,7 @@ class Abstract_Wallet(PrintError):
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
                 self.transactions.pop(tx_hash)
+                self.dirty['transactions'].add(tx_hash)
 
     def start_threads(self, network):
         self.network = network
@@ -1097,7 +1436,7 @@ class Abstract_Wallet(PrintError):
         else:
             return
         coins = self.get_addr_utxo(address)
-        item = coins.get(txid+':%d'%i)
+        item = coins.get(outpoint_key(txid, i))
         if not item:
             return
         self.add_input_info(item)
@@ -1114,7 +1453,7 @@ class Abstract_Wallet(PrintError):
             # segwit needs value to sign
             if txin.get('value') is None and Transaction.is_segwit_input(txin):
                 received, spent = self.get_addr_io(address)
-                item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
+                item = received.get(outpoint_key(txin['prevout_hash'], txin['prevout_n']))
                 tx_height, value, is_cb = item
                 txin['value'] = value
             self.add_input_sig_info(txin, address)
@@ -1200,8 +1539,7 @@ class Abstract_Wallet(PrintError):
         l = []
         for txo, x in received.items():
             h, v, is_cb = x
-            txid, n = txo.split(':')
-            info = self.verified_tx.get(txid)
+            info = self.verified_tx.get(outpoint_hash(txo))
             if info:
                 tx_height, timestamp, pos = info
                 conf = local_height - tx_height
@@ -1354,10 +1692,15 @@ class Abstract_Wallet(PrintError):
         return False
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
+        for address in addresses:
+            if address not in self.history:
+                self.history[address] = []
+                self.dirty['addr_history'].add(address)
         if self.synchronizer:
-            self.synchronizer.add(address)
+            self.synchronizer.add_addresses(addresses)
 
     def has_password(self):
         return self.storage.get('use_encryption', False)
@@ -1450,6 +1793,9 @@ class Imported_Wallet(Simple_Wallet):
     def is_deterministic(self):
         return False
 
+    def is_mine(self, address):
+        return address in self.addresses
+
     def is_change(self, address):
         return False
 
@@ -1497,7 +1843,16 @@ class Imported_Wallet(Simple_Wallet):
                     for tx_hash, height in details:
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
-            self.history.pop(address, None)
+            with self.transaction_lock:
+                for tx_hash, height in self.history.pop(address, []):
+                    s = self.tx_addr_hist.get(tx_hash, set())
+                    s.discard(address)
+                    if not s:
+                        self.tx_addr_hist.pop(tx_hash, None)
+                    self.dirty['tx_addr_hist'].add(tx_hash)
+                self.dirty['addr_history'].add(address)
+                self.invalidate_addr_state([address])
+            self.invalidate_history()
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
@@ -1505,6 +1860,8 @@ class Imported_Wallet(Simple_Wallet):
                 self.verified_tx.pop(tx_hash, None)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)
+                self.dirty['tx_fees'].add(tx_hash)
+                self.dirty['transactions'].add(tx_hash)
                 # FIXME: what about pruned_txo?
 
         self.storage.put('verified_tx3', self.verified_tx)
@@ -1620,6 +1977,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             k = self.num_unused_trailing_addresses(addresses)
             n = len(addresses) - k + value
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_addresses()
@@ -1649,27 +2007,34 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
+        '''Derives the next count addresses of a sequence, and saves and
+        subscribes to them all at once.'''
         assert type(for_change) is bool
         addr_list = self.change_addresses if for_change else self.receiving_addresses
         n = len(addr_list)
-        x = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(x)
-        addr_list.append(address)
+        addresses = [self.pubkeys_to_address(self.derive_pubkeys(for_change, i))
+                     for i in range(n, n + count)]
+        addr_list.extend(addresses)
+        for i, address in enumerate(addresses):
+            self._addr_to_addr_index[address] = (for_change, n + i)
         self.save_addresses()
-        self.add_address(address)
-        return address
+        self.add_addresses(addresses)
+        return addresses
 
     def synchronize_sequence(self, for_change):
+        # the last limit addresses must not be old
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
-            addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change)
-                continue
-            if list(map(lambda a: self.address_is_old(a), addresses[-limit:] )) == limit*[False]:
+        addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+        k = 0
+        for address in addresses[:-limit-1:-1]:
+            if self.address_is_old(address):
                 break
-            else:
-                self.create_new_address(for_change)
+            k += 1
+        if k < limit:
+            self.create_new_addresses(for_change, limit - k)
 
     def synchronize(self):
         with self.lock:
@@ -1680,13 +2045,13 @@ class Deterministic_Wallet(Abstract_Wallet):
                 if len(self.receiving_addresses) != len(self.keystore.keypairs):
                     pubkeys = self.keystore.keypairs.keys()
                     self.receiving_addresses = [self.pubkeys_to_address(i) for i in pubkeys]
+                    self.build_address_index()
                     self.save_addresses()
-                    for addr in self.receiving_addresses:
-                        self.add_address(addr)
+                    self.add_addresses(self.receiving_addresses)
 
     def is_beyond_limit(self, address, is_change):
         addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()
-        i = addr_list.index(address)
+        i = self.get_address_index(address)[1]
         prev_addresses = addr_list[:max(0, i)]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
         if len(prev_addresses) < limit:
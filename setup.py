@@ -26,6 +26,9 @@ def readreqs(path):
 
 install_requires = readreqs('requirements.txt')
 tests_requires = install_requires + readreqs('requirements_travis.txt')
+# NumPy speeds up the batch Equihash verification of header chunks,
+# lib/equihash.py falls back to pure Python without it
+extras_require = {'fast': ['numpy']}
 
 if sys.version_info[:3] < (3, 4, 0):
     sys.exit("Error: Electrum requires Python version >= 3.4.0...")
@@ -53,6 +56,7 @@ setup(
     version=version.ELECTRUM_VERSION,
     install_requires=install_requires,
     tests_require=tests_requires,
+    extras_require=extras_require,
     packages=[
         'electrum',
         'electrum_gui',